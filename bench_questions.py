@@ -0,0 +1,122 @@
+# Микробенчмарк загрузки вопросов: прежняя реализация get_questions + get_prompt
+# против одного запроса QUESTIONS_AND_PROMPT_SQL (обычного и подготовленного).
+#
+# Запуск: python bench_questions.py [--rows 100000] [--iterations 500]
+# Данные создаются во временных таблицах сессии, рабочие таблицы не затрагиваются.
+import argparse
+import logging
+import random
+import time
+from db import (
+    get_connection,
+    filter_questions,
+    MAX_QUESTIONS,
+    QUESTIONS_AND_PROMPT_SQL,
+    QUESTIONS_AND_PROMPT_SQL_PG,
+)
+
+# Прежний запрос get_questions (до переноса логики на сервер)
+LEGACY_QUESTIONS_SQL = """
+SELECT DISTINCT ON (question_text) question_text
+FROM questions
+WHERE business_type = %s
+ORDER BY question_text, question_order
+"""
+LEGACY_PROMPT_SQL = "SELECT prompt_text FROM prompts WHERE business_type = %s"
+
+BUSINESS_TYPES = 100
+
+
+def populate(cur, rows):
+    """Создает временные таблицы questions и prompts, которые перекрывают рабочие в этой сессии."""
+    cur.execute("""
+    CREATE TEMP TABLE questions (
+        id SERIAL PRIMARY KEY,
+        business_type TEXT NOT NULL,
+        question_text TEXT NOT NULL,
+        question_order INT NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TEMP TABLE prompts (
+        id SERIAL PRIMARY KEY,
+        business_type TEXT UNIQUE NOT NULL,
+        prompt_text TEXT NOT NULL
+    )
+    """)
+    # На каждый тип бизнеса приходится rows / BUSINESS_TYPES строк с повторами и пустыми вопросами
+    cur.execute("""
+    INSERT INTO questions (business_type, question_text, question_order)
+    SELECT
+        'type_' || (i %% %(types)s),
+        CASE WHEN i %% 97 = 0 THEN '  ' ELSE 'Вопрос ' || ((i / %(types)s) %% 300) END,
+        (i / %(types)s) %% 50
+    FROM generate_series(1, %(rows)s) AS i
+    """, {"types": BUSINESS_TYPES, "rows": rows})
+    cur.execute("""
+    INSERT INTO prompts (business_type, prompt_text)
+    SELECT 'type_' || i, 'Промпт {}' FROM generate_series(0, %s - 1) AS i
+    """, (BUSINESS_TYPES,))
+    cur.execute("""
+    CREATE INDEX ON questions (business_type, question_text, question_order)
+    """)
+    cur.execute("ANALYZE questions")
+    cur.execute("ANALYZE prompts")
+
+
+def legacy(cur, business_type):
+    cur.execute(LEGACY_QUESTIONS_SQL, (business_type,))
+    questions = filter_questions(business_type, [row[0] for row in cur.fetchall()])
+    cur.execute(LEGACY_PROMPT_SQL, (business_type,))
+    return questions, cur.fetchone()[0]
+
+
+def single_query(cur, business_type):
+    cur.execute(QUESTIONS_AND_PROMPT_SQL, {"business_type": business_type, "limit": MAX_QUESTIONS})
+    return cur.fetchone()
+
+
+def prepared(cur, business_type):
+    cur.execute("EXECUTE questions_and_prompt (%s, %s)", (business_type, MAX_QUESTIONS))
+    return cur.fetchone()
+
+
+def measure(name, func, cur, iterations):
+    types = [f"type_{random.randrange(BUSINESS_TYPES)}" for _ in range(iterations)]
+    # Прогрев
+    for business_type in types[:10]:
+        func(cur, business_type)
+    started = time.perf_counter()
+    for business_type in types:
+        func(cur, business_type)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<16} {elapsed / iterations * 1000:8.3f} мс/вызов  ({iterations} вызовов)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк загрузки вопросов и промпта")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    # Логирование filter_questions искажает замеры
+    logging.getLogger("db").setLevel(logging.ERROR)
+
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        populate(cur, args.rows)
+        cur.execute(f"PREPARE questions_and_prompt (text, int) AS {QUESTIONS_AND_PROMPT_SQL_PG}")
+
+        print(f"Строк в questions: {args.rows}, типов бизнеса: {BUSINESS_TYPES}")
+        measure("legacy", legacy, cur, args.iterations)
+        measure("single query", single_query, cur, args.iterations)
+        measure("prepared", prepared, cur, args.iterations)
+    finally:
+        conn.rollback()
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 # список импортов
 import psycopg2
 import os
+import re
 import logging
 from dotenv import load_dotenv
 
@@ -20,6 +21,116 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DATABASE_URL = os.getenv("DATABASE_URL")  # Для совместимости с Railway
 
+# Стандартный промпт, если для типа бизнеса промпт не задан
+DEFAULT_PROMPT = "На основе следующих ответов составь отзыв:\n\n{}\n\nСоставь связный, теплый отзыв, будто писал клиент, который остался доволен сервисом."
+
+# Максимальное количество вопросов в анкете
+MAX_QUESTIONS = 4
+
+# Схема базы данных (общая для синхронного и асинхронного слоя)
+CREATE_TABLES_SQL = [
+    # Таблица пользователей
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        telegram_id BIGINT UNIQUE,
+        business_type TEXT NOT NULL
+    )
+    """,
+    # Таблица вопросов
+    """
+    CREATE TABLE IF NOT EXISTS questions (
+        id SERIAL PRIMARY KEY,
+        business_type TEXT NOT NULL,
+        question_text TEXT NOT NULL,
+        question_order INT NOT NULL
+    )
+    """,
+    # Таблица для хранения промптов для разных бизнес-типов
+    """
+    CREATE TABLE IF NOT EXISTS prompts (
+        id SERIAL PRIMARY KEY,
+        business_type TEXT UNIQUE NOT NULL,
+        prompt_text TEXT NOT NULL
+    )
+    """,
+    # Таблица учета использования модели по пользователям и типам бизнеса
+    """
+    CREATE TABLE IF NOT EXISTS usage_stats (
+        day DATE NOT NULL,
+        telegram_id BIGINT NOT NULL,
+        business_type TEXT NOT NULL,
+        calls INT NOT NULL DEFAULT 0,
+        tokens INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, telegram_id, business_type)
+    )
+    """,
+    # Индекс под выборку вопросов по типу бизнеса
+    """
+    CREATE INDEX IF NOT EXISTS questions_business_type_idx
+    ON questions (business_type, question_text, question_order)
+    """,
+]
+
+# Непустой вопрос содержит хотя бы один символ не из этого набора. Регулярное выражение
+# одинаково понимают PostgreSQL и модуль re, поэтому правило не зависит от локали сервера
+QUESTION_TEXT_PATTERN = r"[^ \t\n\r\f\v\u001c-\u001f\u0085\u00a0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000\ufeff]"
+_QUESTION_TEXT_RE = re.compile(QUESTION_TEXT_PATTERN)
+
+# Вопросы и промпт за один запрос: сортировка по question_order, удаление
+# дубликатов и пустых вопросов и ограничение количества выполняются на сервере
+_QUESTIONS_AND_PROMPT_TEMPLATE = """
+WITH distinct_questions AS (
+    SELECT DISTINCT ON (question_text) question_text, question_order
+    FROM questions
+    WHERE business_type = {business_type}
+      AND question_text ~ '{pattern}'
+    ORDER BY question_text, question_order
+), top_questions AS (
+    SELECT question_text, question_order
+    FROM distinct_questions
+    ORDER BY question_order, question_text
+    LIMIT {limit}
+)
+SELECT
+    ARRAY(SELECT question_text FROM top_questions ORDER BY question_order, question_text),
+    (SELECT prompt_text FROM prompts WHERE business_type = {business_type})
+"""
+# Вариант для psycopg2
+QUESTIONS_AND_PROMPT_SQL = _QUESTIONS_AND_PROMPT_TEMPLATE.format(
+    business_type="%(business_type)s", limit="%(limit)s", pattern=QUESTION_TEXT_PATTERN
+)
+# Вариант для серверных подготовленных выражений (asyncpg, PREPARE)
+QUESTIONS_AND_PROMPT_SQL_PG = _QUESTIONS_AND_PROMPT_TEMPLATE.format(
+    business_type="$1", limit="$2", pattern=QUESTION_TEXT_PATTERN
+)
+
+def filter_questions(business_type, all_questions):
+    """
+    Оставляет только непустые уникальные вопросы и ограничивает их до MAX_QUESTIONS.
+    """
+    # Дополнительная проверка на уникальность и валидность
+    valid_questions = []
+    seen = set()
+    
+    for question in all_questions:
+        # Проверяем, что вопрос не пустой и не повторяется
+        if question and question not in seen and _QUESTION_TEXT_RE.search(question):
+            seen.add(question)
+            valid_questions.append(question)
+    
+    # Логируем результат
+    logger.info(f"Найдено {len(valid_questions)} уникальных вопросов, ограничиваем до {MAX_QUESTIONS}")
+    
+    # Ограничиваем количество вопросов
+    result = valid_questions[:MAX_QUESTIONS]
+    
+    # Если вопросов меньше необходимого, логируем это
+    if len(result) < MAX_QUESTIONS:
+        logger.warning(f"Внимание: для типа бизнеса {business_type} найдено только {len(result)} вопросов из {MAX_QUESTIONS} необходимых")
+    
+    return result
+
 def get_connection():
     """Возвращает соединение с базой данных."""
     try:
@@ -49,33 +160,8 @@ def create_tables():
         conn = get_connection()
         cur = conn.cursor()
         
-        # Создаем таблицу пользователей
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            telegram_id BIGINT UNIQUE,
-            business_type TEXT NOT NULL
-        )
-        """)
-        
-        # Создаем таблицу вопросов
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS questions (
-            id SERIAL PRIMARY KEY,
-            business_type TEXT NOT NULL,
-            question_text TEXT NOT NULL,
-            question_order INT NOT NULL
-        )
-        """)
-        
-        # Создаем таблицу для хранения промптов для разных бизнес-типов
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS prompts (
-            id SERIAL PRIMARY KEY,
-            business_type TEXT UNIQUE NOT NULL,
-            prompt_text TEXT NOT NULL
-        )
-        """)
+        for statement in CREATE_TABLES_SQL:
+            cur.execute(statement)
         
         conn.commit()
         cur.close()
@@ -111,55 +197,45 @@ def check_user(telegram_id):
         logger.error(f"Ошибка при проверке пользователя: {e}")
         return None
 
-def get_questions(business_type):
+def get_questions_and_prompt(business_type):
     """
-    Возвращает список вопросов для указанного типа бизнеса.
-    Вопросы сортируются по question_order.
-    Возвращаются только уникальные вопросы (максимум 4).
+    Возвращает кортеж (вопросы, промпт) для указанного типа бизнеса одним запросом.
+    Вопросы уникальны, непусты, отсортированы по question_order (максимум 4).
+    Если промпт не найден, возвращается стандартный промпт.
     """
-    logger.info(f"Получение вопросов для типа бизнеса: {business_type}")
+    logger.info(f"Получение вопросов и промпта для типа бизнеса: {business_type}")
     try:
         conn = get_connection()
         cur = conn.cursor()
         
-        # Получаем уникальные вопросы, отсортированные по question_order
-        cur.execute("""
-        SELECT DISTINCT ON (question_text) question_text 
-        FROM questions 
-        WHERE business_type = %s
-        ORDER BY question_text, question_order
-        """, (business_type,))
-        
-        all_questions = [row[0] for row in cur.fetchall()]
-        
-        # Дополнительная проверка на уникальность и валидность
-        valid_questions = []
-        seen = set()
-        
-        for question in all_questions:
-            # Проверяем, что вопрос не пустой и не повторяется
-            if question and question not in seen and len(question.strip()) > 0:
-                seen.add(question)
-                valid_questions.append(question)
-        
-        # Логируем результат
-        logger.info(f"Найдено {len(valid_questions)} уникальных вопросов, ограничиваем до 4")
-        
-        # Ограничиваем до 4 вопросов
-        result = valid_questions[:4]
-        
-        # Если вопросов меньше 4, логируем это
-        if len(result) < 4:
-            logger.warning(f"Внимание: для типа бизнеса {business_type} найдено только {len(result)} вопросов из 4 необходимых")
+        cur.execute(QUESTIONS_AND_PROMPT_SQL, {"business_type": business_type, "limit": MAX_QUESTIONS})
+        questions, prompt = cur.fetchone()
         
         cur.close()
         conn.close()
         
-        return result
+        # Если вопросов меньше необходимого, логируем это
+        if len(questions) < MAX_QUESTIONS:
+            logger.warning(f"Внимание: для типа бизнеса {business_type} найдено только {len(questions)} вопросов из {MAX_QUESTIONS} необходимых")
+        
+        if not prompt:
+            logger.info("Промпт не найден, используем стандартный")
+            prompt = DEFAULT_PROMPT
+        
+        return questions, prompt
     except Exception as e:
-        logger.error(f"Ошибка при получении вопросов: {e}")
-        # В случае ошибки возвращаем пустой список, чтобы бот мог корректно обработать ситуацию
-        return []
+        logger.error(f"Ошибка при получении вопросов и промпта: {e}")
+        # В случае ошибки возвращаем пустой список и стандартный промпт
+        return [], DEFAULT_PROMPT
+
+def get_questions(business_type):
+    """
+    Возвращает список вопросов для указанного типа бизнеса.
+    Вопросы сортируются по question_order.
+    Возвращаются только уникальные вопросы (максимум 4).
+    """
+    questions, _ = get_questions_and_prompt(business_type)
+    return questions
 
 def get_prompt(business_type):
     """
@@ -182,8 +258,61 @@ def get_prompt(business_type):
             return result[0]
         else:
             logger.info("Промпт не найден, используем стандартный")
-            return "На основе следующих ответов составь отзыв:\n\n{}\n\nСоставь связный, теплый отзыв, будто писал клиент, который остался доволен сервисом."
+            return DEFAULT_PROMPT
     except Exception as e:
         logger.error(f"Ошибка при получении промпта: {e}")
         # В случае ошибки возвращаем стандартный промпт
-        return "На основе следующих ответов составь отзыв:\n\n{}\n\nСоставь связный, теплый отзыв, будто писал клиент, который остался доволен сервисом."
\ No newline at end of file
+        return DEFAULT_PROMPT
+
+def save_usage(day, rows):
+    """
+    Добавляет накопленные счетчики использования к данным за указанный день.
+    rows: список кортежей (telegram_id, business_type, calls, tokens).
+    """
+    if not rows:
+        return
+    logger.info(f"Сохранение статистики использования: {len(rows)} записей")
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        
+        cur.executemany("""
+        INSERT INTO usage_stats (day, telegram_id, business_type, calls, tokens)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (day, telegram_id, business_type) DO UPDATE
+        SET calls = usage_stats.calls + EXCLUDED.calls,
+            tokens = usage_stats.tokens + EXCLUDED.tokens
+        """, [(day, telegram_id, business_type, calls, tokens) for telegram_id, business_type, calls, tokens in rows])
+        
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении статистики использования: {e}")
+        raise
+
+def get_usage(day):
+    """
+    Возвращает статистику использования за указанный день
+    в виде списка кортежей (telegram_id, business_type, calls, tokens).
+    """
+    logger.info(f"Получение статистики использования за {day}")
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        
+        cur.execute("""
+        SELECT telegram_id, business_type, calls, tokens
+        FROM usage_stats
+        WHERE day = %s
+        ORDER BY tokens DESC
+        """, (day,))
+        result = cur.fetchall()
+        
+        cur.close()
+        conn.close()
+        
+        return result
+    except Exception as e:
+        logger.error(f"Ошибка при получении статистики использования: {e}")
+        return []
@@ -0,0 +1,221 @@
+# список импортов
+import os
+import logging
+from abc import ABC, abstractmethod
+from db import (
+    DB_HOST,
+    DB_NAME,
+    DB_USER,
+    DB_PASSWORD,
+    DATABASE_URL,
+    DEFAULT_PROMPT,
+    MAX_QUESTIONS,
+    CREATE_TABLES_SQL,
+    QUESTIONS_AND_PROMPT_SQL_PG,
+    filter_questions,
+)
+
+logger = logging.getLogger(__name__)
+
+# Размер пула соединений для асинхронного слоя
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+
+
+class AsyncDatabase(ABC):
+    """
+    Общий интерфейс асинхронного доступа к базе данных.
+    Повторяет функции модуля db, но не блокирует цикл событий asyncio.
+    """
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def create_tables(self):
+        ...
+
+    @abstractmethod
+    async def check_user(self, telegram_id):
+        ...
+
+    @abstractmethod
+    async def get_questions(self, business_type):
+        ...
+
+    @abstractmethod
+    async def get_prompt(self, business_type):
+        ...
+
+    async def get_questions_and_prompt(self, business_type):
+        return await self.get_questions(business_type), await self.get_prompt(business_type)
+
+
+class AsyncpgDatabase(AsyncDatabase):
+    """Реализация на asyncpg с собственным пулом соединений."""
+
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+
+    async def connect(self):
+        """Создает пул соединений с базой данных."""
+        import asyncpg
+
+        try:
+            # Пробуем сначала через отдельные параметры
+            if DB_HOST and DB_NAME and DB_USER and DB_PASSWORD:
+                logger.info(f"Создаю пул соединений с базой данных {DB_NAME} на сервере {DB_HOST}")
+                self.pool = await asyncpg.create_pool(
+                    host=DB_HOST,
+                    database=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                )
+            # Если какие-то параметры отсутствуют, пробуем через URL
+            elif DATABASE_URL:
+                logger.info("Создаю пул соединений через DATABASE_URL")
+                self.pool = await asyncpg.create_pool(
+                    DATABASE_URL, min_size=self.min_size, max_size=self.max_size
+                )
+            else:
+                raise ValueError("Не настроены параметры подключения к базе данных")
+        except Exception as e:
+            logger.error(f"Ошибка подключения к базе данных: {e}")
+            raise
+
+    async def close(self):
+        """Закрывает пул соединений."""
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def create_tables(self):
+        """Создает таблицы в базе данных, если они не существуют."""
+        logger.info("Создание таблиц в базе данных...")
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    for statement in CREATE_TABLES_SQL:
+                        await conn.execute(statement)
+            logger.info("Таблицы успешно созданы")
+        except Exception as e:
+            logger.error(f"Ошибка при создании таблиц: {e}")
+            raise
+
+    async def check_user(self, telegram_id):
+        """
+        Проверяет, есть ли пользователь в базе данных.
+        Возвращает business_type если пользователь найден, иначе None.
+        """
+        logger.info(f"Проверка пользователя с Telegram ID: {telegram_id}")
+        try:
+            result = await self.pool.fetchval(
+                "SELECT business_type FROM users WHERE telegram_id = $1", telegram_id
+            )
+            if result:
+                logger.info(f"Пользователь найден, business_type: {result}")
+            else:
+                logger.info("Пользователь не найден")
+            return result
+        except Exception as e:
+            logger.error(f"Ошибка при проверке пользователя: {e}")
+            return None
+
+    async def get_questions_and_prompt(self, business_type):
+        """
+        Возвращает кортеж (вопросы, промпт) для указанного типа бизнеса одним запросом.
+        asyncpg выполняет его как подготовленное выражение и кэширует его в каждом соединении пула.
+        """
+        logger.info(f"Получение вопросов и промпта для типа бизнеса: {business_type}")
+        try:
+            row = await self.pool.fetchrow(QUESTIONS_AND_PROMPT_SQL_PG, business_type, MAX_QUESTIONS)
+            questions, prompt = list(row[0]), row[1]
+            if len(questions) < MAX_QUESTIONS:
+                logger.warning(f"Внимание: для типа бизнеса {business_type} найдено только {len(questions)} вопросов из {MAX_QUESTIONS} необходимых")
+            if not prompt:
+                logger.info("Промпт не найден, используем стандартный")
+                prompt = DEFAULT_PROMPT
+            return questions, prompt
+        except Exception as e:
+            logger.error(f"Ошибка при получении вопросов и промпта: {e}")
+            return [], DEFAULT_PROMPT
+
+    async def get_questions(self, business_type):
+        """
+        Возвращает список вопросов для указанного типа бизнеса.
+        Вопросы сортируются по question_order (максимум 4).
+        """
+        questions, _ = await self.get_questions_and_prompt(business_type)
+        return questions
+
+    async def get_prompt(self, business_type):
+        """
+        Возвращает промпт для указанного типа бизнеса.
+        Если промпт не найден, возвращает стандартный промпт.
+        """
+        logger.info(f"Получение промпта для типа бизнеса: {business_type}")
+        try:
+            result = await self.pool.fetchval(
+                "SELECT prompt_text FROM prompts WHERE business_type = $1", business_type
+            )
+            if result:
+                logger.info("Промпт найден в базе данных")
+                return result
+            logger.info("Промпт не найден, используем стандартный")
+            return DEFAULT_PROMPT
+        except Exception as e:
+            logger.error(f"Ошибка при получении промпта: {e}")
+            # В случае ошибки возвращаем стандартный промпт
+            return DEFAULT_PROMPT
+
+
+class FakeDatabase(AsyncDatabase):
+    """
+    Хранилище в памяти процесса с тем же интерфейсом.
+    Используется в тестах и нагрузочных прогонах без PostgreSQL.
+    """
+
+    def __init__(self, users=None, questions=None, prompts=None):
+        # users: {telegram_id: business_type}
+        self.users = dict(users or {})
+        # questions: {business_type: [(question_text, question_order), ...]}
+        self.questions = {key: list(value) for key, value in (questions or {}).items()}
+        # prompts: {business_type: prompt_text}
+        self.prompts = dict(prompts or {})
+        self.tables_created = False
+
+    async def create_tables(self):
+        self.tables_created = True
+
+    async def check_user(self, telegram_id):
+        return self.users.get(telegram_id)
+
+    async def get_questions(self, business_type):
+        # Для каждого текста берем наименьший question_order, как DISTINCT ON в SQL
+        orders = {}
+        for question_text, question_order in self.questions.get(business_type, []):
+            if question_text not in orders or question_order < orders[question_text]:
+                orders[question_text] = question_order
+        ordered = sorted(orders, key=lambda text: (orders[text], text))
+        return filter_questions(business_type, ordered)
+
+    async def get_prompt(self, business_type):
+        return self.prompts.get(business_type) or DEFAULT_PROMPT
+
+
+def get_async_database() -> AsyncDatabase:
+    """
+    Возвращает реализацию асинхронного слоя по переменной окружения DB_BACKEND
+    ("asyncpg" по умолчанию или "fake").
+    """
+    backend = os.getenv("DB_BACKEND", "asyncpg").lower()
+    if backend == "fake":
+        return FakeDatabase()
+    return AsyncpgDatabase()
@@ -0,0 +1,333 @@
+# список импортов
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple, deque
+import openai
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+# Выбор реализации: openai, record, replay или template
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai").lower()
+# Файл с записанными ответами модели (для record и replay)
+LLM_RECORD_FILE = os.getenv("LLM_RECORD_FILE", "llm_records.jsonl")
+# Задержка при воспроизведении: "recorded" — как при записи, число — фиксированная в секундах
+LLM_REPLAY_LATENCY = os.getenv("LLM_REPLAY_LATENCY", "0")
+# Строгий режим воспроизведения: отсутствующая запись — ошибка, а не шаблонный ответ
+LLM_REPLAY_STRICT = os.getenv("LLM_REPLAY_STRICT", "0") == "1"
+# Таймаут одного запроса к OpenAI (секунды)
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "30"))
+
+# Параметры автоматического выключателя (circuit breaker)
+LLM_BREAKER_ENABLED = os.getenv("LLM_BREAKER_ENABLED", "1") == "1"
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "5"))
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_LATENCY = float(os.getenv("LLM_BREAKER_LATENCY", "15"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))
+
+# Результат обращения к модели: тексты вариантов и израсходованные токены
+LLMResult = namedtuple("LLMResult", ["texts", "total_tokens"])
+
+
+def request_key(model, messages, temperature, max_tokens, n):
+    """Ключ запроса для поиска записанного ответа."""
+    raw = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens, "n": n},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class RecordingNotFoundError(Exception):
+    """В строгом режиме воспроизведения для запроса нет записанного ответа."""
+
+
+class CircuitOpenError(Exception):
+    """Выключатель разомкнут: модель считается недоступной, запрос не отправлялся."""
+
+
+# Ошибки, означающие недоступность модели. Остальные (неверный запрос, отказ
+# по политике содержимого и т.п.) относятся к конкретному запросу
+OUTAGE_ERRORS = (
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.RateLimitError,
+    openai.error.TryAgain,
+    TimeoutError,
+    ConnectionError,
+)
+
+
+def is_outage_error(error) -> bool:
+    """Относится ли ошибка к недоступности модели, а не к конкретному запросу."""
+    return isinstance(error, (CircuitOpenError,) + OUTAGE_ERRORS)
+
+
+class LLMBackend(ABC):
+    """
+    Общий интерфейс обращения к языковой модели.
+    template_input — структурированные данные запроса для генераторов без сети:
+    {"answers": [...]} для отзыва по ответам или
+    {"review": ..., "max_sentences": ..., "combined": ...} для переписывания.
+    Реализации, обращающиеся к модели, его игнорируют.
+    """
+
+    @abstractmethod
+    def complete(self, model, messages, temperature, max_tokens, n=1, template_input=None) -> LLMResult:
+        ...
+
+    def available(self) -> bool:
+        """Можно ли сейчас рассчитывать на ответ модели."""
+        return True
+
+
+class OpenAIBackend(LLMBackend):
+    """Реальные запросы к OpenAI API."""
+
+    def complete(self, model, messages, temperature, max_tokens, n=1, template_input=None) -> LLMResult:
+        response = openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            n=n,
+            request_timeout=LLM_REQUEST_TIMEOUT,
+        )
+        texts = [choice.message.content.strip() for choice in response.choices]
+        return LLMResult(texts, response.usage.total_tokens)
+
+
+class RecordingBackend(LLMBackend):
+    """Проксирует запросы в другую реализацию и дописывает ответы в файл JSON Lines."""
+
+    def __init__(self, inner, path=LLM_RECORD_FILE):
+        self.inner = inner
+        self.path = path
+        self.lock = threading.Lock()
+
+    def complete(self, model, messages, temperature, max_tokens, n=1, template_input=None) -> LLMResult:
+        started = time.monotonic()
+        result = self.inner.complete(model, messages, temperature, max_tokens, n, template_input)
+        record = {
+            "key": request_key(model, messages, temperature, max_tokens, n),
+            "messages": messages,
+            "texts": result.texts,
+            "total_tokens": result.total_tokens,
+            "latency": round(time.monotonic() - started, 3),
+        }
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return result
+
+
+class ReplayBackend(LLMBackend):
+    """
+    Воспроизводит ответы, записанные RecordingBackend.
+    Для незаписанных запросов использует fallback (по умолчанию шаблонный генератор),
+    а в строгом режиме бросает RecordingNotFoundError.
+    """
+
+    def __init__(self, path=LLM_RECORD_FILE, latency=LLM_REPLAY_LATENCY, fallback=None, strict=LLM_REPLAY_STRICT):
+        self.records = {}
+        self.latency = latency
+        self.strict = strict
+        self.fallback = fallback or TemplateBackend()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.records[record["key"]] = record
+        logger.info(f"Загружено {len(self.records)} записанных ответов из {path}")
+
+    def complete(self, model, messages, temperature, max_tokens, n=1, template_input=None) -> LLMResult:
+        key = request_key(model, messages, temperature, max_tokens, n)
+        record = self.records.get(key)
+        if record is None:
+            if self.strict:
+                raise RecordingNotFoundError(f"Нет записанного ответа для запроса {key}")
+            logger.warning("Записанный ответ не найден, используем шаблонный генератор")
+            return self.fallback.complete(model, messages, temperature, max_tokens, n, template_input)
+
+        delay = record.get("latency", 0) if self.latency == "recorded" else float(self.latency)
+        if delay:
+            time.sleep(delay)
+        return LLMResult(list(record["texts"]), record["total_tokens"])
+
+
+# Шаблоны для детерминированной генерации отзыва по ответам
+REVIEW_TEMPLATES = [
+    "Хочу поблагодарить за отличный сервис. {answers} Обязательно приду еще и буду рекомендовать знакомым!",
+    "Остался очень доволен. {answers} Спасибо всей команде за внимательное отношение!",
+    "Прекрасные впечатления от визита. {answers} Рекомендую!",
+]
+
+
+def template_review(answers, variant=0) -> str:
+    """Собирает отзыв из ответов клиента по шаблону без обращения к модели."""
+    parts = []
+    for answer in answers:
+        answer = answer.strip().rstrip(".!?")
+        if answer:
+            parts.append(answer[0].upper() + answer[1:] + ".")
+    template = REVIEW_TEMPLATES[variant % len(REVIEW_TEMPLATES)]
+    return template.format(answers=" ".join(parts)).replace("  ", " ")
+
+
+class TemplateBackend(LLMBackend):
+    """
+    Детерминированный генератор без сети. Работает только со структурированными
+    данными template_input: собирает отзыв из ответов, а при переписывании
+    возвращает исходный отзыв, сокращенный до max_sentences предложений.
+    """
+
+    def complete(self, model, messages, temperature, max_tokens, n=1, template_input=None) -> LLMResult:
+        if not template_input:
+            raise ValueError("Шаблонному генератору нужны структурированные данные запроса")
+
+        if "review" in template_input:
+            # Переписывание: оставляем первые предложения исходного отзыва
+            sentences = re.split(r"(?<=[.!?])\s+", template_input["review"].strip())
+            max_sentences = template_input.get("max_sentences")
+            text = " ".join(sentences[:max_sentences] if max_sentences else sentences)
+            if template_input.get("combined"):
+                text = json.dumps({"personalized": text, "final": text}, ensure_ascii=False)
+            texts = [text] * n
+        else:
+            texts = [template_review(template_input.get("answers", []), variant) for variant in range(n)]
+        return LLMResult(texts, sum(len(text.split()) for text in texts))
+
+
+class CircuitBreaker:
+    """
+    Размыкается, когда в окне последних вызовов доля ошибок (включая слишком
+    медленные ответы) достигает порога. После паузы пропускает один пробный
+    вызов: при успехе замыкается, при ошибке снова ждет.
+    Каждый разрешенный вызов получает от allow() метку и передает ее в record(),
+    чтобы результаты вызовов, начатых до смены состояния, не влияли на новое.
+    """
+
+    def __init__(
+        self,
+        window=LLM_BREAKER_WINDOW,
+        min_calls=LLM_BREAKER_MIN_CALLS,
+        error_rate=LLM_BREAKER_ERROR_RATE,
+        latency_threshold=LLM_BREAKER_LATENCY,
+        cooldown=LLM_BREAKER_COOLDOWN,
+    ):
+        self.results = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.latency_threshold = latency_threshold
+        self.cooldown = cooldown
+        self.opened_at = None
+        # Номер периода замкнутого состояния: меняется при каждом размыкании и замыкании
+        self.generation = 0
+        # Метка пробного вызова в полуоткрытом состоянии
+        self.trial = None
+        self.lock = threading.Lock()
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def allow(self):
+        """
+        Разрешает вызов и возвращает его метку или None, если вызов запрещен.
+        В полуоткрытом состоянии пропускает только один пробный вызов.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return self.generation
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial is not None:
+                return None
+            self.trial = object()
+            return self.trial
+
+    def record(self, ticket, success, latency):
+        """Учитывает результат вызова с меткой ticket, полученной от allow()."""
+        with self.lock:
+            if latency > self.latency_threshold:
+                logger.warning(f"Медленный ответ модели: {latency:.1f} с")
+                success = False
+
+            if self.opened_at is not None:
+                # Пока выключатель разомкнут, значение имеет только пробный вызов;
+                # вызовы, начатые до размыкания, игнорируются
+                if ticket is not self.trial:
+                    return
+                self.trial = None
+                if success:
+                    logger.info("Модель снова доступна, выключатель замкнут")
+                    self.opened_at = None
+                    self.generation += 1
+                    self.results.clear()
+                else:
+                    self.opened_at = time.monotonic()
+                return
+
+            # Вызов начат в прошлом периоде замкнутого состояния
+            if ticket != self.generation:
+                return
+            self.results.append(success)
+            failures = self.results.count(False)
+            if len(self.results) >= self.min_calls and failures / len(self.results) >= self.error_rate:
+                logger.warning(f"Выключатель разомкнут: {failures} ошибок из {len(self.results)} вызовов")
+                self.opened_at = time.monotonic()
+                self.generation += 1
+
+
+class BreakerBackend(LLMBackend):
+    """Оборачивает другую реализацию автоматическим выключателем."""
+
+    def __init__(self, inner, breaker=None):
+        self.inner = inner
+        self.breaker = breaker or CircuitBreaker()
+
+    def complete(self, model, messages, temperature, max_tokens, n=1, template_input=None) -> LLMResult:
+        ticket = self.breaker.allow()
+        if ticket is None:
+            raise CircuitOpenError("Модель временно недоступна")
+        started = time.monotonic()
+        try:
+            result = self.inner.complete(model, messages, temperature, max_tokens, n, template_input)
+        except Exception as e:
+            # Ошибка конкретного запроса означает, что модель отвечает: выключатель
+            # учитывает ее как успешный вызов, чтобы один плохой запрос его не размыкал
+            self.breaker.record(ticket, not is_outage_error(e), time.monotonic() - started)
+            raise
+        self.breaker.record(ticket, True, time.monotonic() - started)
+        return result
+
+    def available(self) -> bool:
+        return not self.breaker.is_open()
+
+
+def get_backend() -> LLMBackend:
+    """Возвращает реализацию по переменной окружения LLM_BACKEND."""
+    if LLM_BACKEND == "template":
+        return TemplateBackend()
+    if LLM_BACKEND == "replay":
+        return ReplayBackend()
+    if LLM_BACKEND == "record":
+        backend = RecordingBackend(OpenAIBackend())
+    else:
+        backend = OpenAIBackend()
+    # Выключатель нужен только для сетевых реализаций
+    if LLM_BREAKER_ENABLED:
+        backend = BreakerBackend(backend)
+    return backend
@@ -1,8 +1,10 @@
+import json
 import logging
 import urllib.parse
 import os
 import openai
 import random
+from collections import deque
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -14,7 +16,9 @@ from telegram.ext import (
     ConversationHandler,
     CallbackContext,
 )
-from db import check_user, get_questions, get_prompt, create_tables
+from db import check_user, get_questions_and_prompt, get_prompt, create_tables
+from llm import get_backend, template_review, is_outage_error
+from usage import UsageTracker, QuotaExceededError, USAGE_FLUSH_INTERVAL, format_report
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -23,6 +27,13 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Администраторы, которым доступен отчет /usage
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+# Сколько вариантов отзыва запрашивать у модели за один вызов
+# (по умолчанию 1: каждый дополнительный вариант оплачивается отдельно)
+REVIEW_VARIANTS = max(1, int(os.getenv("REVIEW_VARIANTS", "1")))
+
 # Определяем состояния диалога
 START_MENU, QUESTION, CONFIRM_REVIEW, EDIT_REVIEW_STATE, HUMANIZE_PROCESSING, DEMOGRAPHIC_CHOICE = range(6)
 
@@ -35,6 +46,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Учет обращений к модели и квоты
+usage_tracker = UsageTracker()
+
+# Реализация обращений к модели (OpenAI, запись/воспроизведение или шаблоны)
+llm_backend = get_backend()
+
+# Очередь отзывов, собранных по шаблону, для повторной генерации моделью
+REGENERATION_INTERVAL = int(os.getenv("REGENERATION_INTERVAL", "30"))
+REGENERATION_QUEUE_SIZE = int(os.getenv("REGENERATION_QUEUE_SIZE", "1000"))
+REGENERATION_MAX_ATTEMPTS = int(os.getenv("REGENERATION_MAX_ATTEMPTS", "5"))
+regeneration_queue = deque()
+
+# Готовые улучшенные версии: {telegram_id: [варианты]}.
+# Хранятся вне user_data, чтобы их не стирал перезапуск анкеты
+regenerated_reviews = {}
+
+# --- Обращение к модели с проверкой квот ---
+def unique_variants(texts) -> list:
+    """Оставляет только непустые и неповторяющиеся варианты."""
+    variants = []
+    for text in texts:
+        if text and text not in variants:
+            variants.append(text)
+    return variants
+
+def chat_completion(telegram_id, business_type, model, messages, temperature, max_tokens, n=1, template_input=None) -> list:
+    """
+    Проверяет квоты пользователя и типа бизнеса, вызывает модель и учитывает
+    израсходованные токены. Возвращает список текстов вариантов.
+    template_input передается генераторам без сети (см. llm.LLMBackend).
+    Бросает QuotaExceededError, если квота исчерпана.
+    """
+    reserved_at = usage_tracker.check_quota(telegram_id, business_type)
+    try:
+        result = llm_backend.complete(model, messages, temperature, max_tokens, n, template_input)
+    except Exception:
+        # Неудачный вызов (в том числе отклоненный выключателем) не расходует минутную квоту
+        usage_tracker.release(telegram_id, reserved_at)
+        raise
+    usage_tracker.record(telegram_id, business_type, result.total_tokens)
+    return result.texts
+
 # Словарь профилей для персонализации
 demographic_profiles = {
     "young_male": {
@@ -69,6 +122,183 @@ demographic_profiles = {
     }
 }
 
+# Ограничение длины для переписанных отзывов (в предложениях)
+REWRITE_MAX_SENTENCES = int(os.getenv("REWRITE_MAX_SENTENCES", "4"))
+
+# Правила очеловечивания отзыва
+HUMANIZE_RULES = [
+    "Используй разговорную речь, простые предложения и 1-2 эмоциональных выражения (благодарность, радость)",
+    "Хвали конкретно, но кратко",
+    "Избегай перечислений множества деталей, излишне восторженных прилагательных и повторений",
+]
+
+# --- Конвейер переписывания отзыва ---
+def build_rewrite_prompt(review, profile=None, humanize=False, max_sentences=REWRITE_MAX_SENTENCES) -> str:
+    """
+    Собирает выбранные преобразования (демографический профиль, очеловечивание,
+    ограничение длины) в один промпт, чтобы выполнить их одним запросом к модели.
+    Если выбраны и профиль, и очеловечивание, модель возвращает JSON с обеими
+    версиями, чтобы промежуточная осталась доступной пользователю.
+    """
+    if profile:
+        intro = (
+            f"Перепиши этот отзыв так, чтобы он звучал как отзыв от {profile['name']}.\n\n"
+            f"Стиль написания: {profile['style']}\n"
+            f"Клиент ценит: {profile['characteristics']}"
+        )
+    else:
+        intro = "Перепиши этот отзыв так, чтобы он звучал как настоящий отзыв довольного пациента."
+    
+    rules = []
+    if max_sentences:
+        rules.append(f"Отзыв должен быть ОЧЕНЬ коротким (не более {max_sentences} предложений)")
+    if profile:
+        rules.append("Используй речевые обороты, характерные для данной демографической группы")
+        rules.append("Добавь 1-2 специфических детали, характерных для этой группы клиентов")
+    if humanize and not profile:
+        rules.extend(HUMANIZE_RULES)
+    rules.append("Избегай слишком формального языка")
+    rules.append("Сохрани основные положительные моменты из исходного отзыва")
+    
+    rules_text = "\n".join(f"{i+1}. {rule}" for i, rule in enumerate(rules))
+    prompt = (
+        f"{intro}\n\n"
+        f"Правила:\n{rules_text}\n\n"
+        f"Вот исходный отзыв:\n\"{review}\"\n\n"
+    )
+    if profile and humanize:
+        humanize_text = "\n".join(f"- {rule}" for rule in HUMANIZE_RULES)
+        return prompt + (
+            f"Затем сделай из персонализированной версии итоговую, более короткую и естественную:\n"
+            f"{humanize_text}\n\n"
+            f"Верни только JSON без пояснений: "
+            f"{{\"personalized\": \"<персонализированная версия>\", \"final\": \"<итоговая версия>\"}}"
+        )
+    return prompt + "Верни только новую версию отзыва."
+
+def parse_rewrite_result(text) -> tuple:
+    """
+    Разбирает JSON-ответ комбинированного переписывания на (итоговая версия, промежуточная версия).
+    Бросает ValueError, если ответ не разбирается (например, обрезан по max_tokens)
+    или итоговая версия пуста: показывать пользователю сырой JSON нельзя.
+    """
+    cleaned = text.strip().strip("`").strip()
+    if cleaned.startswith("json"):
+        cleaned = cleaned[len("json"):]
+    try:
+        data = json.loads(cleaned)
+        final = data["final"].strip()
+        intermediate = (data.get("personalized") or "").strip() or None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Ответ модели не в формате JSON: {e}") from e
+    if not final:
+        raise ValueError("Модель вернула пустую итоговую версию")
+    return final, intermediate
+
+def rewrite_review(telegram_id, business_type, review, profile=None, humanize=False, max_sentences=REWRITE_MAX_SENTENCES) -> tuple:
+    """
+    Выполняет все выбранные преобразования отзыва за один вызов модели.
+    Возвращает (итоговая версия, промежуточная версия или None).
+    """
+    combined = bool(profile and humanize)
+    texts = chat_completion(
+        telegram_id,
+        business_type,
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": "Ты эксперт по созданию коротких, естественных и реалистичных отзывов от лица разных типов клиентов."},
+            {"role": "user", "content": build_rewrite_prompt(review, profile, humanize, max_sentences)},
+        ],
+        temperature=0.85 if profile else 0.8,
+        # Для двух версий нужен больший запас токенов
+        max_tokens=400 if combined else 200,
+        template_input={"review": review, "max_sentences": max_sentences, "combined": combined},
+    )
+    if combined:
+        return parse_rewrite_result(texts[0])
+    return texts[0], None
+
+# Максимальная длина ссылки для кнопок «поделиться»
+# (кириллица при URL-кодировании занимает 6 символов на букву)
+MAX_SHARE_URL_LENGTH = int(os.getenv("MAX_SHARE_URL_LENGTH", "4096"))
+
+# --- Ссылки для отправки отзыва ---
+def build_share_payload(review: str) -> dict:
+    """
+    Готовит ссылки для отправки отзыва в WhatsApp и Telegram.
+    Ссылка, превышающая MAX_SHARE_URL_LENGTH, заменяется на None.
+    """
+    encoded_text = urllib.parse.quote(review)
+    urls = {
+        "whatsapp_url": f"https://api.whatsapp.com/send?text={encoded_text}",
+        "telegram_url": f"https://t.me/share/url?url={encoded_text}",
+    }
+    
+    payload = {}
+    for key, url in urls.items():
+        if len(url) <= MAX_SHARE_URL_LENGTH:
+            payload[key] = url
+        else:
+            logger.warning(f"Ссылка {key} слишком длинная ({len(url)} символов), кнопка не показывается")
+            payload[key] = None
+    return payload
+
+def set_generated_review(context: CallbackContext, review: str):
+    """Сохраняет текущий отзыв и сразу пересчитывает ссылки для отправки."""
+    context.user_data["generated_review"] = review
+    context.user_data["share_payload"] = build_share_payload(review)
+
+def share_buttons(context: CallbackContext) -> list:
+    payload = context.user_data.get("share_payload")
+    if payload is None:
+        payload = build_share_payload(context.user_data.get("generated_review", ""))
+        context.user_data["share_payload"] = payload
+    
+    # Готовая ссылка открывает WhatsApp сразу, без промежуточного экрана
+    if payload["whatsapp_url"]:
+        buttons = [InlineKeyboardButton("✅ Отправить в WhatsApp", url=payload["whatsapp_url"])]
+    else:
+        buttons = [InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp")]
+    if payload["telegram_url"]:
+        buttons.append(InlineKeyboardButton("📨 Поделиться в Telegram", url=payload["telegram_url"]))
+    return buttons
+
+# --- Клавиатура экрана отзыва ---
+def review_keyboard(context: CallbackContext, personalize=True, restore=False, variants=False) -> InlineKeyboardMarkup:
+    first_row = [InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review")]
+    if personalize:
+        first_row.append(InlineKeyboardButton("👤 Персонализировать", callback_data="personalize_review"))
+    keyboard = [first_row, share_buttons(context)]
+    
+    # Кнопка перелистывания нужна, только если модель вернула несколько вариантов
+    if variants and len(context.user_data.get("review_variants", [])) > 1:
+        keyboard.append([InlineKeyboardButton("➡️ Другой вариант", callback_data="next_variant")])
+    
+    # Версии комбинированного переписывания, кроме показанной сейчас
+    if restore:
+        versions = context.user_data.get("rewrite_versions", {})
+        current = context.user_data.get("generated_review")
+        version_row = []
+        if versions.get("personalized") and versions["personalized"] != current:
+            version_row.append(InlineKeyboardButton("🎭 Только персонализация", callback_data="rewrite_version_personalized"))
+        if versions.get("final") and versions["final"] != current:
+            version_row.append(InlineKeyboardButton("✨ Итоговая версия", callback_data="rewrite_version_final"))
+        if version_row:
+            keyboard.append(version_row)
+        keyboard.append([
+            InlineKeyboardButton("🔙 Восстановить исходный", callback_data="restore_original"),
+            InlineKeyboardButton("🔄 Начать заново", callback_data="restart"),
+        ])
+    else:
+        keyboard.append([InlineKeyboardButton("🔄 Начать заново", callback_data="restart")])
+    return InlineKeyboardMarkup(keyboard)
+
+def variant_label(context: CallbackContext) -> str:
+    variants = context.user_data.get("review_variants", [])
+    if len(variants) <= 1:
+        return ""
+    return f" (вариант {context.user_data.get('variant_index', 0) + 1}/{len(variants)})"
+
 # --- Функция стартового меню ---
 def start(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
@@ -85,7 +315,7 @@ def start(update: Update, context: CallbackContext) -> int:
     
     # Сохраняем данные в контексте
     context.user_data["business_type"] = business_type
-    context.user_data["questions"] = get_questions(business_type)
+    context.user_data["questions"], context.user_data["prompt"] = get_questions_and_prompt(business_type)
     
     if not context.user_data["questions"]:
         if update.message:
@@ -181,50 +411,93 @@ def question_callback_handler(update: Update, context: CallbackContext) -> int:
             # Генерация отзыва
             answers = context.user_data.get("answers", [])
             business_type = context.user_data.get("business_type")
-            prompt_template = get_prompt(business_type)
+            # Промпт загружается вместе с вопросами, отдельный запрос нужен только для старых сессий
+            prompt_template = context.user_data.get("prompt") or get_prompt(business_type)
             answers_text = "\n".join(f"{i+1}. {ans}" for i, ans in enumerate(answers))
             prompt = prompt_template.format(answers_text)
             
+            messages = [
+                {"role": "system", "content": "Ты помогаешь составить отзыв для клиники."},
+                {"role": "user", "content": prompt},
+            ]
+            is_fallback = False
+            is_queued = False
+            
             query.edit_message_text(text="Формирую отзыв, подождите...")
             
             try:
-                response = openai.ChatCompletion.create(
+                texts = chat_completion(
+                    update.effective_user.id,
+                    business_type,
                     model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "Ты помогаешь составить отзыв для клиники."},
-                        {"role": "user", "content": prompt},
-                    ],
+                    messages=messages,
                     temperature=0.7,
                     max_tokens=200,
+                    n=REVIEW_VARIANTS,
+                    template_input={"answers": answers},
+                )
+                variants = unique_variants(texts)
+                if not variants:
+                    raise ValueError("Модель вернула пустой ответ")
+            except QuotaExceededError as e:
+                # Ответы сохраняются, генерацию можно повторить позже
+                context.user_data["current_question"] = current_q - 1
+                keyboard = [[InlineKeyboardButton("🔁 Повторить", callback_data="next_question")]]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                query.edit_message_text(
+                    text=f"⏳ {e}\nВаши ответы сохранены, нажмите «Повторить» позже.",
+                    reply_markup=reply_markup
                 )
-                generated_review = response.choices[0].message.content.strip()
+                return QUESTION
             except Exception as e:
                 logger.error(f"Ошибка OpenAI API: {e}")
-                query.edit_message_text(text="Ошибка при генерации отзыва.")
-                return ConversationHandler.END
+                # Модель недоступна: собираем черновик по шаблону из ответов, чтобы не потерять их,
+                # а генерацию моделью ставим в очередь
+                variants = unique_variants([template_review(answers, i) for i in range(REVIEW_VARIANTS)])
+                is_fallback = True
+                is_queued = len(regeneration_queue) < REGENERATION_QUEUE_SIZE
+                if is_queued:
+                    regeneration_queue.append({
+                        "chat_id": update.effective_chat.id,
+                        "telegram_id": update.effective_user.id,
+                        "business_type": business_type,
+                        "messages": messages,
+                        "template_input": {"answers": list(answers)},
+                        "attempts": 0,
+                    })
+                else:
+                    logger.warning(
+                        f"Очередь повторной генерации заполнена ({REGENERATION_QUEUE_SIZE}), "
+                        f"отзыв пользователя {update.effective_user.id} останется шаблонным"
+                    )
 
-            context.user_data["generated_review"] = generated_review
+            context.user_data["review_variants"] = variants
+            context.user_data["variant_index"] = 0
+            generated_review = variants[0]
+            set_generated_review(context, generated_review)
             context.user_data["original_review"] = generated_review
             
-            keyboard = [
-                [
-                    InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-                    InlineKeyboardButton("👤 Персонализировать", callback_data="personalize_review"),
-                    InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-                ],
-                [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            query.edit_message_text(
-                text=f"🎉 Отзыв сформирован:\n\"{generated_review}\"", reply_markup=reply_markup
-            )
+            reply_markup = review_keyboard(context, variants=True)
+            if is_fallback:
+                text = (
+                    f"⚠️ Сервис генерации сейчас недоступен, отзыв собран по шаблону{variant_label(context)}:\n"
+                    f"\"{generated_review}\""
+                )
+                # Обещаем улучшенную версию, только если запрос действительно попал в очередь
+                if is_queued:
+                    text += "\n\nМы пришлем улучшенную версию, как только сервис восстановится."
+            else:
+                text = f"🎉 Отзыв сформирован{variant_label(context)}:\n\"{generated_review}\""
+            query.edit_message_text(text=text, reply_markup=reply_markup)
             return CONFIRM_REVIEW
     
     elif query.data == "back_to_menu":
         # Сброс данных и возврат в меню
         context.user_data.clear()
         context.user_data["business_type"] = check_user(update.effective_user.id)
-        context.user_data["questions"] = get_questions(context.user_data["business_type"])
+        context.user_data["questions"], context.user_data["prompt"] = get_questions_and_prompt(
+            context.user_data["business_type"]
+        )
         
         keyboard = [
             [InlineKeyboardButton("✅ Начать анкетирование", callback_data="start_survey")],
@@ -249,46 +522,42 @@ def review_callback_handler(update: Update, context: CallbackContext) -> int:
         return EDIT_REVIEW_STATE
     
     elif query.data == "send_whatsapp":
+        # Ссылка не поместилась в кнопку экрана отзыва, предлагаем скопировать текст
         review = context.user_data.get("generated_review", "")
-        encoded_text = urllib.parse.quote(review)
-        whatsapp_url = f"https://api.whatsapp.com/send?text={encoded_text}"
+        payload = context.user_data.get("share_payload") or build_share_payload(review)
         
         keyboard = [
-            [InlineKeyboardButton("Открыть WhatsApp", url=whatsapp_url)],
             [
                 InlineKeyboardButton("Назад", callback_data="back_from_whatsapp"),
                 InlineKeyboardButton("Отредактировать отзыв", callback_data="edit_review"),
                 InlineKeyboardButton("🔄 Начать заново", callback_data="restart"),
             ],
         ]
+        if payload["whatsapp_url"]:
+            keyboard.insert(0, [InlineKeyboardButton("Открыть WhatsApp", url=payload["whatsapp_url"])])
+            text = "Отправьте отзыв через WhatsApp:"
+        else:
+            text = f"Отзыв слишком длинный для ссылки. Скопируйте текст и отправьте его вручную:\n\n{review}"
         reply_markup = InlineKeyboardMarkup(keyboard)
-        query.edit_message_text(
-            text="Отправьте отзыв через WhatsApp:", reply_markup=reply_markup
-        )
+        query.edit_message_text(text=text, reply_markup=reply_markup)
         return CONFIRM_REVIEW
     
     elif query.data == "back_from_whatsapp":
         generated_review = context.user_data.get("generated_review", "")
-        keyboard = [
-            [
-                InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-                InlineKeyboardButton("👤 Персонализировать", callback_data="personalize_review"),
-                InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-            ],
-            [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = review_keyboard(context, variants=True)
         query.edit_message_text(
-            text=f"🎉 Отзыв сформирован:\n\"{generated_review}\"", reply_markup=reply_markup
+            text=f"🎉 Отзыв сформирован{variant_label(context)}:\n\"{generated_review}\"", reply_markup=reply_markup
         )
         return CONFIRM_REVIEW
     
     elif query.data == "restart":
         business_type = context.user_data.get("business_type")
         questions = context.user_data.get("questions", [])
+        prompt = context.user_data.get("prompt")
         context.user_data.clear()
         context.user_data["business_type"] = business_type
         context.user_data["questions"] = questions
+        context.user_data["prompt"] = prompt
         
         keyboard = [
             [InlineKeyboardButton("✅ Начать анкетирование", callback_data="start_survey")],
@@ -298,16 +567,32 @@ def review_callback_handler(update: Update, context: CallbackContext) -> int:
         query.edit_message_text(text="📌 Выберите действие:", reply_markup=reply_markup)
         return START_MENU
 
-# --- Обработчик выбора демографии ---
-def personalize_review_handler(update: Update, context: CallbackContext) -> int:
+# --- Обработчик перелистывания вариантов отзыва ---
+def next_variant_handler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     query.answer()
     
-    # Сохраняем текущий отзыв
-    review = context.user_data.get("generated_review", "")
-    context.user_data["original_review"] = review
+    variants = context.user_data.get("review_variants", [])
+    if not variants:
+        return CONFIRM_REVIEW
+    
+    # Варианты уже получены вместе с первым, поэтому переключение мгновенное
+    index = (context.user_data.get("variant_index", 0) + 1) % len(variants)
+    context.user_data["variant_index"] = index
+    generated_review = variants[index]
+    set_generated_review(context, generated_review)
+    context.user_data["original_review"] = generated_review
     
-    # Создаем клавиатуру с демографическими опциями
+    reply_markup = review_keyboard(context, variants=True)
+    query.edit_message_text(
+        text=f"🎉 Отзыв сформирован{variant_label(context)}:\n\"{generated_review}\"",
+        reply_markup=reply_markup
+    )
+    return CONFIRM_REVIEW
+
+# --- Клавиатура выбора демографии ---
+def demographic_keyboard(context: CallbackContext) -> InlineKeyboardMarkup:
+    humanize_mark = "✅" if context.user_data.get("rewrite_humanize") else "☐"
     keyboard = [
         [
             InlineKeyboardButton("👨 Молодой человек (18-30)", callback_data="demo_young_male"),
@@ -321,17 +606,123 @@ def personalize_review_handler(update: Update, context: CallbackContext) -> int:
             InlineKeyboardButton("👴 Пожилой человек", callback_data="demo_elderly"),
             InlineKeyboardButton("🎲 Случайный", callback_data="demo_random"),
         ],
+        [InlineKeyboardButton(f"{humanize_mark} Заодно очеловечить", callback_data="toggle_humanize")],
         [InlineKeyboardButton("◀️ Назад", callback_data="back_to_review")],
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+# --- Обработчик перехода на отзыв, сгенерированный после восстановления сервиса ---
+def use_regenerated_handler(update: Update, context: CallbackContext):
+    """
+    Сообщение с улучшенной версией приходит асинхронно, поэтому обработчик
+    зарегистрирован как точка входа и как fallback диалога и работает из любого состояния.
+    """
+    query = update.callback_query
+    user_id = update.effective_user.id
+    
+    variants = regenerated_reviews.pop(user_id, None)
+    if not variants:
+        query.answer(text="Эта версия отзыва уже недоступна.", show_alert=True)
+        query.edit_message_reply_markup(reply_markup=None)
+        return None
+    query.answer()
+    
+    # Если диалог уже завершен, восстанавливаем данные, нужные экрану отзыва
+    if not context.user_data.get("business_type"):
+        business_type = check_user(user_id)
+        if not business_type:
+            query.edit_message_text(text="Вы не авторизованы. Обратитесь к администратору.")
+            return ConversationHandler.END
+        context.user_data["business_type"] = business_type
+        context.user_data["questions"], context.user_data["prompt"] = get_questions_and_prompt(business_type)
+    
+    context.user_data["review_variants"] = variants
+    context.user_data["variant_index"] = 0
+    generated_review = variants[0]
+    set_generated_review(context, generated_review)
+    context.user_data["original_review"] = generated_review
+    
+    reply_markup = review_keyboard(context, variants=True)
+    query.edit_message_text(
+        text=f"🎉 Отзыв сформирован{variant_label(context)}:\n\"{generated_review}\"",
+        reply_markup=reply_markup
+    )
+    return CONFIRM_REVIEW
+
+# --- Повторная генерация отзывов, собранных по шаблону ---
+def process_regeneration_queue(context: CallbackContext):
+    # За один проход обрабатываем не больше задач, чем было в очереди в начале
+    for _ in range(len(regeneration_queue)):
+        if not regeneration_queue or not llm_backend.available():
+            break
+        job = regeneration_queue.popleft()
+        try:
+            result = llm_backend.complete(
+                "gpt-4o", job["messages"], 0.7, 200, REVIEW_VARIANTS, job["template_input"]
+            )
+            variants = unique_variants(result.texts)
+            if not variants:
+                raise ValueError("Модель вернула пустой ответ")
+        except Exception as e:
+            if is_outage_error(e):
+                # Модель недоступна: остальные задачи тоже не пройдут, ждем следующего запуска.
+                # Сбой сервиса не считается попыткой, иначе долгий сбой отменил бы все задачи
+                logger.warning(f"Повторная генерация отложена, модель недоступна: {e}")
+                regeneration_queue.appendleft(job)
+                break
+            job["attempts"] += 1
+            if job["attempts"] >= REGENERATION_MAX_ATTEMPTS:
+                logger.error(
+                    f"Повторная генерация для пользователя {job['telegram_id']} отменена "
+                    f"после {job['attempts']} попыток: {e}"
+                )
+                context.bot.send_message(
+                    chat_id=job["chat_id"],
+                    text="😔 Не удалось подготовить улучшенную версию отзыва. Используйте текущий вариант или начните заново."
+                )
+                continue
+            logger.warning(f"Повторная генерация не удалась (попытка {job['attempts']}): {e}")
+            # Ошибка конкретного запроса не должна задерживать остальные задачи
+            regeneration_queue.append(job)
+            continue
+        
+        usage_tracker.record(job["telegram_id"], job["business_type"], result.total_tokens)
+        
+        # Предлагаем новую версию, не подменяя отзыв, который пользователь мог уже изменить
+        regenerated_reviews[job["telegram_id"]] = variants
+        keyboard = [[InlineKeyboardButton("✅ Использовать эту версию", callback_data="use_regenerated")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        context.bot.send_message(
+            chat_id=job["chat_id"],
+            text=f"✨ Сервис восстановлен, готова улучшенная версия отзыва:\n\"{variants[0]}\"",
+            reply_markup=reply_markup
+        )
+
+# --- Обработчик выбора демографии ---
+def personalize_review_handler(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    
+    # Сохраняем текущий отзыв
+    review = context.user_data.get("generated_review", "")
+    context.user_data["original_review"] = review
     
     query.edit_message_text(
         text=f"👤 Выберите тип клиента для персонализации отзыва:\n\n"
              f"Текущий отзыв:\n\"{review}\"",
-        reply_markup=reply_markup
+        reply_markup=demographic_keyboard(context)
     )
     return DEMOGRAPHIC_CHOICE
 
+# --- Обработчик переключателя очеловечивания при персонализации ---
+def toggle_humanize_handler(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    
+    context.user_data["rewrite_humanize"] = not context.user_data.get("rewrite_humanize", False)
+    query.edit_message_reply_markup(reply_markup=demographic_keyboard(context))
+    return DEMOGRAPHIC_CHOICE
+
 # --- Обработчик возврата к экрану отзыва ---
 def back_to_review_handler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
@@ -339,18 +730,10 @@ def back_to_review_handler(update: Update, context: CallbackContext) -> int:
     
     review = context.user_data.get("generated_review", "")
     
-    keyboard = [
-        [
-            InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-            InlineKeyboardButton("👤 Персонализировать", callback_data="personalize_review"),
-            InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-        ],
-        [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = review_keyboard(context, variants=True)
     
     query.edit_message_text(
-        text=f"🎉 Отзыв сформирован:\n\"{review}\"",
+        text=f"🎉 Отзыв сформирован{variant_label(context)}:\n\"{review}\"",
         reply_markup=reply_markup
     )
     return CONFIRM_REVIEW
@@ -364,18 +747,10 @@ def restore_original_review_handler(update: Update, context: CallbackContext) ->
     original_review = context.user_data.get("original_review", "")
     
     # Восстанавливаем исходный отзыв
-    context.user_data["generated_review"] = original_review
+    set_generated_review(context, original_review)
     
     # Создаем клавиатуру с кнопкой персонализации
-    keyboard = [
-        [
-            InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-            InlineKeyboardButton("👤 Персонализировать", callback_data="personalize_review"),
-            InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-        ],
-        [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = review_keyboard(context)
     
     query.edit_message_text(
         text=f"🔄 Восстановлен исходный отзыв:\n\n\"{original_review}\"",
@@ -383,6 +758,27 @@ def restore_original_review_handler(update: Update, context: CallbackContext) ->
     )
     return CONFIRM_REVIEW
 
+# --- Обработчик переключения между версиями комбинированного переписывания ---
+def rewrite_version_handler(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    query.answer()
+    
+    versions = context.user_data.get("rewrite_versions", {})
+    version = query.data.replace("rewrite_version_", "")
+    review = versions.get(version)
+    if not review:
+        return CONFIRM_REVIEW
+    
+    set_generated_review(context, review)
+    reply_markup = review_keyboard(context, personalize=False, restore=True)
+    
+    title = "Только персонализация" if version == "personalized" else "Итоговая версия"
+    query.edit_message_text(
+        text=f"🎭 {title} (стиль {versions.get('profile_name', '')}):\n\n\"{review}\"",
+        reply_markup=reply_markup
+    )
+    return CONFIRM_REVIEW
+
 # --- Обработчик выбора демографии ---
 def demographic_choice_handler(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
@@ -390,6 +786,7 @@ def demographic_choice_handler(update: Update, context: CallbackContext) -> int:
     
     demographic_type = query.data.replace("demo_", "")
     review = context.user_data.get("original_review", "")
+    humanize = context.user_data.get("rewrite_humanize", False)
     
     query.edit_message_text(text="Персонализирую отзыв, подождите...")
     
@@ -399,83 +796,50 @@ def demographic_choice_handler(update: Update, context: CallbackContext) -> int:
     
     profile = demographic_profiles.get(demographic_type)
     
-    # Промпт для персонализации отзыва
-    personalize_prompt = f"""
-    Перепиши этот отзыв так, чтобы он звучал как отзыв от {profile["name"]}.
-    
-    Стиль написания: {profile["style"]}
-    Клиент ценит: {profile["characteristics"]}
-    
-    Правила:
-    1. Отзыв должен быть ОЧЕНЬ коротким (2-4 предложения максимум)
-    2. Используй речевые обороты, характерные для данной демографической группы
-    3. Избегай слишком формального языка
-    4. Сохрани основные положительные моменты из исходного отзыва
-    5. Добавь 1-2 специфических детали, характерных для этой группы клиентов
-    
-    Вот исходный отзыв:
-    "{review}"
-    
-    Создай короткую, персонализированную версию отзыва.
-    """
-    
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": f"Ты эксперт по созданию реалистичных отзывов от лица разных типов клиентов."},
-                {"role": "user", "content": personalize_prompt},
-            ],
-            temperature=0.85,
-            max_tokens=200,
+        # Персонализация и очеловечивание выполняются одним запросом,
+        # исходный отзыв остается в original_review для восстановления
+        personalized_review, intermediate_review = rewrite_review(
+            update.effective_user.id,
+            context.user_data.get("business_type"),
+            review,
+            profile=profile,
+            humanize=humanize,
         )
-        personalized_review = response.choices[0].message.content.strip()
-        context.user_data["generated_review"] = personalized_review
+        set_generated_review(context, personalized_review)
+        # Промежуточная версия (только персонализация) остается доступной наравне с итоговой
+        if intermediate_review:
+            context.user_data["rewrite_versions"] = {
+                "personalized": intermediate_review,
+                "final": personalized_review,
+                "profile_name": profile["name"],
+            }
+        else:
+            context.user_data["rewrite_versions"] = {}
         
         # Клавиатура с кнопкой восстановления исходного отзыва
-        keyboard = [
-            [
-                InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-                InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-            ],
-            [
-                InlineKeyboardButton("🔙 Восстановить исходный", callback_data="restore_original"),
-                InlineKeyboardButton("🔄 Начать заново", callback_data="restart"),
-            ],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = review_keyboard(context, personalize=False, restore=True)
         
-        profile_name = demographic_profiles.get(demographic_type)["name"]
+        title = "Отзыв персонализирован и очеловечен" if humanize else "Отзыв персонализирован"
         query.edit_message_text(
-            text=f"🎭 Отзыв персонализирован (стиль {profile_name}):\n\n\"{personalized_review}\"",
+            text=f"🎭 {title} (стиль {profile['name']}):\n\n\"{personalized_review}\"",
             reply_markup=reply_markup
         )
         return CONFIRM_REVIEW
+    except QuotaExceededError as e:
+        query.edit_message_text(
+            text=f"⏳ {e}\n\nТекущий отзыв:\n\"{review}\"",
+            reply_markup=demographic_keyboard(context)
+        )
+        return DEMOGRAPHIC_CHOICE
     except Exception as e:
         logger.error(f"Ошибка OpenAI API при персонализации: {e}")
         
         # В случае ошибки возвращаем к выбору демографии
-        keyboard = [
-            [
-                InlineKeyboardButton("👨 Молодой человек (18-30)", callback_data="demo_young_male"),
-                InlineKeyboardButton("👩 Молодая женщина (18-30)", callback_data="demo_young_female"),
-            ],
-            [
-                InlineKeyboardButton("👨‍💼 Мужчина средних лет", callback_data="demo_middle_male"),
-                InlineKeyboardButton("👩‍👧 Женщина с детьми", callback_data="demo_woman_children"),
-            ],
-            [
-                InlineKeyboardButton("👴 Пожилой человек", callback_data="demo_elderly"),
-                InlineKeyboardButton("🎲 Случайный", callback_data="demo_random"),
-            ],
-            [InlineKeyboardButton("◀️ Назад", callback_data="back_to_review")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         query.edit_message_text(
             text=f"❌ Ошибка при персонализации отзыва. Попробуйте еще раз.\n\n"
                  f"Текущий отзыв:\n\"{review}\"",
-            reply_markup=reply_markup
+            reply_markup=demographic_keyboard(context)
         )
         return DEMOGRAPHIC_CHOICE
 
@@ -488,73 +852,32 @@ def humanize_review_handler(update: Update, context: CallbackContext) -> int:
     
     query.edit_message_text(text="Очеловечиваю отзыв, подождите...")
     
-    # Обновленный промпт для "очеловечивания" отзыва
-    humanize_prompt = """
-    Ты эксперт по созданию коротких, естественных отзывов клиентов. 
-    Твоя задача — переписать предоставленный отзыв так, чтобы он был:
-    1. Очень лаконичным (максимум 2-4 коротких предложения)
-    2. Звучал как настоящий отзыв довольного пациента
-
-    Используй:
-    - разговорную речь и простые конструкции предложений
-    - 1-2 эмоциональных выражения (благодарность, радость)
-    - конкретную, но краткую похвалу
-    - уместные разговорные фразы
-
-    Избегай:
-    - длинных, сложных предложений
-    - перечислений множества деталей
-    - излишне восторженных прилагательных
-    - повторений
-    - слишком формального языка
-
-    ОЧЕНЬ ВАЖНО: отзыв должен быть коротким (2-4 предложения), так как реальные пациенты не пишут длинные отзывы.
-
-    Вот отзыв, который нужно сделать коротким и человечным:
-    "{review}"
-
-    Создай новую, более короткую и естественную версию этого отзыва.
-    """
-    
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Ты помогаешь сделать отзыв клиента более коротким, естественным и человечным."},
-                {"role": "user", "content": humanize_prompt.format(review=review)},
-            ],
-            temperature=0.8,
-            max_tokens=200,
+        humanized_review, _ = rewrite_review(
+            update.effective_user.id,
+            context.user_data.get("business_type"),
+            review,
+            humanize=True,
         )
-        humanized_review = response.choices[0].message.content.strip()
-        context.user_data["generated_review"] = humanized_review
+        set_generated_review(context, humanized_review)
         
         # Клавиатура без кнопки "Очеловечить"
-        keyboard = [
-            [
-                InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-                InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-            ],
-            [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = review_keyboard(context, personalize=False)
         query.edit_message_text(
             text=f"🎉 Отзыв очеловечен:\n\"{humanized_review}\"", reply_markup=reply_markup
         )
         return CONFIRM_REVIEW
+    except QuotaExceededError as e:
+        query.edit_message_text(
+            text=f"⏳ {e}\n\nВаш отзыв:\n\"{review}\"",
+            reply_markup=review_keyboard(context)
+        )
+        return CONFIRM_REVIEW
     except Exception as e:
         logger.error(f"Ошибка OpenAI API при очеловечивании: {e}")
         
         # В случае ошибки возвращаем исходную клавиатуру
-        keyboard = [
-            [
-                InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-                InlineKeyboardButton("👤 Персонализировать", callback_data="personalize_review"),
-                InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-            ],
-            [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = review_keyboard(context)
         query.edit_message_text(
             text=f"❌ Ошибка при очеловечивании отзыва. Попробуйте еще раз.\n\nВаш отзыв:\n\"{review}\"",
             reply_markup=reply_markup
@@ -564,17 +887,9 @@ def humanize_review_handler(update: Update, context: CallbackContext) -> int:
 # --- Обработчик редактирования отзыва ---
 def edit_review_handler(update: Update, context: CallbackContext) -> int:
     edited_review = update.message.text
-    context.user_data["generated_review"] = edited_review
+    set_generated_review(context, edited_review)
     
-    keyboard = [
-        [
-            InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-            InlineKeyboardButton("👤 Персонализировать", callback_data="personalize_review"),
-            InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-        ],
-        [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = review_keyboard(context)
     update.message.reply_text(
         f"Ваш отредактированный отзыв:\n\"{edited_review}\"\nВыберите действие:", reply_markup=reply_markup
     )
@@ -585,17 +900,9 @@ def cancel_edit_handler(update: Update, context: CallbackContext) -> int:
     query.answer()
     
     generated_review = context.user_data.get("generated_review", "")
-    keyboard = [
-        [
-            InlineKeyboardButton("✏️ Отредактировать отзыв", callback_data="edit_review"),
-            InlineKeyboardButton("👤 Персонализировать", callback_data="personalize_review"),
-            InlineKeyboardButton("✅ Отправить в WhatsApp", callback_data="send_whatsapp"),
-        ],
-        [InlineKeyboardButton("🔄 Начать заново", callback_data="restart")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = review_keyboard(context, variants=True)
     query.edit_message_text(
-        text=f"Отзыв сохранён:\n\"{generated_review}\"", reply_markup=reply_markup
+        text=f"Отзыв сохранён{variant_label(context)}:\n\"{generated_review}\"", reply_markup=reply_markup
     )
     return CONFIRM_REVIEW
 
@@ -604,14 +911,33 @@ def cancel(update: Update, context: CallbackContext) -> int:
     update.message.reply_text("Диалог отменен.")
     return ConversationHandler.END
 
+# --- Отчет об использовании модели (для администраторов) ---
+def usage_report(update: Update, context: CallbackContext):
+    if update.effective_user.id not in ADMIN_IDS:
+        update.message.reply_text("Команда доступна только администраторам.")
+        return
+    update.message.reply_text(format_report(usage_tracker))
+
+def flush_usage(context: CallbackContext):
+    usage_tracker.flush()
+
 # --- Главная функция ---
 def main():
     create_tables()
+    usage_tracker.load()
     updater = Updater(TELEGRAM_TOKEN, use_context=True)
     dp = updater.dispatcher
+    
+    # Периодически сохраняем счетчики использования в базу
+    updater.job_queue.run_repeating(flush_usage, interval=USAGE_FLUSH_INTERVAL, first=USAGE_FLUSH_INTERVAL)
+    # Периодически пробуем сгенерировать отзывы, собранные по шаблону во время сбоя
+    updater.job_queue.run_repeating(process_regeneration_queue, interval=REGENERATION_INTERVAL, first=REGENERATION_INTERVAL)
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[
+            CommandHandler("start", start),
+            CallbackQueryHandler(use_regenerated_handler, pattern="^use_regenerated$"),
+        ],
         states={
             START_MENU: [CallbackQueryHandler(start_menu_handler, pattern="^(start_survey|cancel)$")],
             QUESTION: [
@@ -635,6 +961,14 @@ def main():
                     restore_original_review_handler, 
                     pattern="^restore_original$"
                 ),
+                CallbackQueryHandler(
+                    next_variant_handler, 
+                    pattern="^next_variant$"
+                ),
+                CallbackQueryHandler(
+                    rewrite_version_handler, 
+                    pattern="^rewrite_version_(personalized|final)$"
+                ),
             ],
             EDIT_REVIEW_STATE: [
                 CallbackQueryHandler(cancel_edit_handler, pattern="^cancel_edit$"),
@@ -643,14 +977,20 @@ def main():
             DEMOGRAPHIC_CHOICE: [
                 CallbackQueryHandler(demographic_choice_handler, pattern="^demo_"),
                 CallbackQueryHandler(back_to_review_handler, pattern="^back_to_review$"),
+                CallbackQueryHandler(toggle_humanize_handler, pattern="^toggle_humanize$"),
             ],
         },
-        fallbacks=[CommandHandler("cancel", cancel)],
+        fallbacks=[
+            CommandHandler("cancel", cancel),
+            CallbackQueryHandler(use_regenerated_handler, pattern="^use_regenerated$"),
+        ],
     )
 
     dp.add_handler(conv_handler)
+    dp.add_handler(CommandHandler("usage", usage_report))
     updater.start_polling()
     updater.idle()
+    usage_tracker.flush()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,73 @@
+import asyncio
+import re
+import sys
+
+import pytest
+
+from db import DEFAULT_PROMPT, QUESTION_TEXT_PATTERN, QUESTIONS_AND_PROMPT_SQL, QUESTIONS_AND_PROMPT_SQL_PG
+from db_async import AsyncDatabase, FakeDatabase
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_incomplete_backend_fails_on_creation():
+    class Incomplete(AsyncDatabase):
+        async def check_user(self, telegram_id):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_check_user():
+    db = FakeDatabase(users={1: "clinic"})
+    assert run(db.check_user(1)) == "clinic"
+    assert run(db.check_user(2)) is None
+
+
+def test_questions_are_ordered_deduplicated_and_limited():
+    db = FakeDatabase(questions={"clinic": [
+        ("Второй", 2),
+        ("Первый", 1),
+        ("Первый", 7),
+        ("   ", 0),
+        ("Третий", 3),
+        ("Четвертый", 4),
+        ("Пятый", 5),
+    ]})
+    assert run(db.get_questions("clinic")) == ["Первый", "Второй", "Третий", "Четвертый"]
+    assert run(db.get_questions("unknown")) == []
+
+
+def test_prompt_falls_back_to_default():
+    db = FakeDatabase(prompts={"clinic": "Промпт {}"})
+    assert run(db.get_prompt("clinic")) == "Промпт {}"
+    assert run(db.get_prompt("unknown")) == DEFAULT_PROMPT
+
+
+def test_questions_and_prompt_together():
+    db = FakeDatabase(questions={"clinic": [("Вопрос", 1)]}, prompts={"clinic": "Промпт {}"})
+    assert run(db.get_questions_and_prompt("clinic")) == (["Вопрос"], "Промпт {}")
+
+
+def test_blank_questions_use_the_same_rule_as_sql():
+    db = FakeDatabase(questions={"clinic": [
+        ("\u00a0", 1),
+        ("\t\f\v", 2),
+        ("\u3000\u2009", 3),
+        ("\u00a0Вопрос\u00a0", 4),
+    ]})
+    assert run(db.get_questions("clinic")) == ["\u00a0Вопрос\u00a0"]
+    # Серверный фильтр использует то же регулярное выражение
+    assert f"question_text ~ '{QUESTION_TEXT_PATTERN}'" in QUESTIONS_AND_PROMPT_SQL
+    assert f"question_text ~ '{QUESTION_TEXT_PATTERN}'" in QUESTIONS_AND_PROMPT_SQL_PG
+
+
+def test_blank_pattern_covers_python_whitespace():
+    pattern = re.compile(QUESTION_TEXT_PATTERN)
+    for code in range(sys.maxunicode + 1):
+        char = chr(code)
+        if char.isspace():
+            assert not pattern.search(char), hex(code)
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from llm import LLMBackend, TemplateBackend, RecordingBackend, ReplayBackend, RecordingNotFoundError
+
+MESSAGES = [{"role": "user", "content": "1. Не больше 3 предложений\n2. Упомяни врача\n\n{}"}]
+
+
+def test_template_review_uses_answers_not_prompt():
+    result = TemplateBackend().complete("gpt-4o", MESSAGES, 0.7, 200, 2, {"answers": ["лечил зуб\nбез боли"]})
+    assert len(result.texts) == 2
+    assert all("Лечил зуб" in text for text in result.texts)
+    assert not any("Упомяни врача" in text for text in result.texts)
+
+
+def test_template_rewrite_respects_sentence_limit():
+    review = "Раз. Два! Три? Четыре. Пять."
+    result = TemplateBackend().complete("gpt-4o", MESSAGES, 0.8, 200, 1, {"review": review, "max_sentences": 2})
+    assert result.texts == ["Раз. Два!"]
+
+    combined = TemplateBackend().complete(
+        "gpt-4o", MESSAGES, 0.8, 400, 1, {"review": review, "max_sentences": 1, "combined": True}
+    )
+    assert json.loads(combined.texts[0]) == {"personalized": "Раз.", "final": "Раз."}
+
+
+def test_template_requires_structured_input():
+    with pytest.raises(ValueError):
+        TemplateBackend().complete("gpt-4o", MESSAGES, 0.7, 200, 1)
+
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / "records.jsonl")
+    recorded = RecordingBackend(TemplateBackend(), path).complete(
+        "gpt-4o", MESSAGES, 0.7, 200, 1, {"answers": ["отлично"]}
+    )
+    replayed = ReplayBackend(path, latency="0", strict=True).complete("gpt-4o", MESSAGES, 0.7, 200, 1)
+    assert replayed == recorded
+
+
+def test_strict_replay_raises_on_missing_record(tmp_path):
+    backend = ReplayBackend(str(tmp_path / "missing.jsonl"), latency="0", strict=True)
+    with pytest.raises(RecordingNotFoundError):
+        backend.complete("gpt-4o", MESSAGES, 0.7, 200, 1, {"answers": ["отлично"]})
+
+
+def test_incomplete_backend_fails_on_creation():
+    class Incomplete(LLMBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
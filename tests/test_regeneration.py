@@ -0,0 +1,242 @@
+from unittest import mock
+
+import pytest
+
+import llm
+import main
+from llm import LLMBackend, LLMResult, BreakerBackend, CircuitBreaker, CircuitOpenError
+
+
+class StubBackend(LLMBackend):
+    """Отвечает по ключу template_input["answers"][0]: "bad" — ошибка запроса, "down" — сбой сервиса."""
+
+    def __init__(self):
+        self.calls = []
+
+    def complete(self, model, messages, temperature, max_tokens, n=1, template_input=None):
+        key = template_input["answers"][0]
+        self.calls.append(key)
+        if key == "bad":
+            raise ValueError("content policy")
+        if key == "down":
+            raise TimeoutError("timeout")
+        return LLMResult([f"Отзыв {key}"], 10)
+
+
+def make_job(key, telegram_id):
+    return {
+        "chat_id": telegram_id,
+        "telegram_id": telegram_id,
+        "business_type": "clinic",
+        "messages": [],
+        "template_input": {"answers": [key]},
+        "attempts": 0,
+    }
+
+
+@pytest.fixture
+def queue_env(monkeypatch):
+    backend = StubBackend()
+    monkeypatch.setattr(main, "llm_backend", backend)
+    monkeypatch.setattr(main, "usage_tracker", mock.Mock())
+    monkeypatch.setattr(main, "regeneration_queue", main.deque())
+    monkeypatch.setattr(main, "regenerated_reviews", {})
+    monkeypatch.setattr(main, "REGENERATION_MAX_ATTEMPTS", 3)
+    return backend, mock.Mock()
+
+
+def test_failing_job_does_not_block_queue(queue_env):
+    backend, context = queue_env
+    main.regeneration_queue.extend([make_job("bad", 1), make_job("a", 2), make_job("b", 3)])
+
+    main.process_regeneration_queue(context)
+
+    assert backend.calls == ["bad", "a", "b"]
+    assert main.regenerated_reviews == {2: ["Отзыв a"], 3: ["Отзыв b"]}
+    assert [job["template_input"]["answers"][0] for job in main.regeneration_queue] == ["bad"]
+
+
+def test_failing_job_is_dropped_after_max_attempts(queue_env):
+    backend, context = queue_env
+    main.regeneration_queue.append(make_job("bad", 1))
+
+    for _ in range(3):
+        main.process_regeneration_queue(context)
+
+    assert backend.calls == ["bad"] * 3
+    assert not main.regeneration_queue
+    # Пользователь узнает, что улучшенной версии не будет
+    assert context.bot.send_message.call_args.kwargs["chat_id"] == 1
+
+
+def test_outage_stops_the_run_and_keeps_order(queue_env):
+    backend, context = queue_env
+    main.regeneration_queue.extend([make_job("down", 1), make_job("a", 2)])
+
+    main.process_regeneration_queue(context)
+
+    assert backend.calls == ["down"]
+    assert [job["telegram_id"] for job in main.regeneration_queue] == [1, 2]
+
+
+def test_long_outage_does_not_drop_jobs(queue_env):
+    backend, context = queue_env
+    main.regeneration_queue.append(make_job("down", 1))
+
+    for _ in range(main.REGENERATION_MAX_ATTEMPTS * 4):
+        main.process_regeneration_queue(context)
+
+    assert len(main.regeneration_queue) == 1
+    assert main.regeneration_queue[0]["attempts"] == 0
+    context.bot.send_message.assert_not_called()
+
+    # После восстановления сервиса пользователь получает улучшенную версию
+    main.regeneration_queue[0]["template_input"] = {"answers": ["a"]}
+    main.process_regeneration_queue(context)
+    assert main.regenerated_reviews == {1: ["Отзыв a"]}
+
+
+def test_request_errors_do_not_open_breaker():
+    breaker = CircuitBreaker(window=10, min_calls=3, error_rate=0.5, latency_threshold=60, cooldown=60)
+    backend = BreakerBackend(StubBackend(), breaker)
+
+    for _ in range(5):
+        with pytest.raises(ValueError):
+            backend.complete("gpt-4o", [], 0.7, 200, 1, {"answers": ["bad"]})
+    assert backend.available()
+
+    # Окно из 10 вызовов: 5 ответов модели и 5 сбоев дают долю ошибок 0.5
+    for _ in range(5):
+        with pytest.raises(TimeoutError):
+            backend.complete("gpt-4o", [], 0.7, 200, 1, {"answers": ["down"]})
+    with pytest.raises(CircuitOpenError):
+        backend.complete("gpt-4o", [], 0.7, 200, 1, {"answers": ["a"]})
+
+
+def test_use_regenerated_without_pending_version_answers_query(monkeypatch):
+    monkeypatch.setattr(main, "regenerated_reviews", {})
+    update = mock.Mock()
+    update.effective_user.id = 1
+
+    assert main.use_regenerated_handler(update, mock.Mock()) is None
+    assert update.callback_query.answer.call_args.kwargs["show_alert"] is True
+
+
+def test_use_regenerated_survives_restart(monkeypatch):
+    monkeypatch.setattr(main, "regenerated_reviews", {1: ["Новый отзыв"]})
+    update = mock.Mock()
+    update.effective_user.id = 1
+    context = mock.Mock()
+    context.user_data = {"business_type": "clinic"}
+
+    assert main.use_regenerated_handler(update, context) == main.CONFIRM_REVIEW
+    assert context.user_data["generated_review"] == "Новый отзыв"
+    assert 1 not in main.regenerated_reviews
+
+
+def test_outage_draft_uses_answers_not_prompt(monkeypatch):
+    class DownBackend(LLMBackend):
+        def complete(self, *args, **kwargs):
+            raise CircuitOpenError("down")
+
+    monkeypatch.setattr(main, "llm_backend", DownBackend())
+    monkeypatch.setattr(main, "usage_tracker", mock.Mock())
+    monkeypatch.setattr(main, "regeneration_queue", main.deque())
+    update = mock.Mock()
+    update.callback_query.data = "next_question"
+    context = mock.Mock()
+    context.user_data = {
+        "current_question": 0,
+        "questions": ["Что лечили?"],
+        "answers": ["лечил зуб\nбез боли"],
+        "business_type": "clinic",
+        "prompt": "1. Не больше 3 предложений\n2. Упомяни врача\n\n{}",
+    }
+
+    assert main.question_callback_handler(update, context) == main.CONFIRM_REVIEW
+    review = context.user_data["generated_review"]
+    assert "Упомяни врача" not in review
+    assert "без боли" in review
+    assert len(main.regeneration_queue) == 1
+
+
+def test_full_queue_does_not_promise_regeneration(monkeypatch):
+    class DownBackend(LLMBackend):
+        def complete(self, *args, **kwargs):
+            raise CircuitOpenError("down")
+
+    monkeypatch.setattr(main, "llm_backend", DownBackend())
+    monkeypatch.setattr(main, "usage_tracker", mock.Mock())
+    monkeypatch.setattr(main, "regeneration_queue", main.deque([make_job("a", 2)]))
+    monkeypatch.setattr(main, "REGENERATION_QUEUE_SIZE", 1)
+    update = mock.Mock()
+    update.callback_query.data = "next_question"
+    context = mock.Mock()
+    context.user_data = {
+        "current_question": 0,
+        "questions": ["Что лечили?"],
+        "answers": ["зуб"],
+        "business_type": "clinic",
+        "prompt": "{}",
+    }
+
+    main.question_callback_handler(update, context)
+    text = update.callback_query.edit_message_text.call_args.kwargs["text"]
+    assert "пришлем" not in text
+    assert len(main.regeneration_queue) == 1
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record(breaker.allow(), False, 0)
+    assert breaker.is_open()
+
+
+def test_stale_call_does_not_resolve_half_open_state(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(llm.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(window=10, min_calls=2, error_rate=0.5, latency_threshold=60, cooldown=60)
+
+    # Вызов начат до размыкания и завершится, когда выключатель уже полуоткрыт
+    stale = breaker.allow()
+    open_breaker(breaker)
+    now[0] = 61
+    trial = breaker.allow()
+    assert trial is not None
+
+    breaker.record(stale, True, 0)
+    # Опоздавший результат не замыкает выключатель и не освобождает место пробного вызова
+    assert breaker.opened_at is not None
+    assert breaker.allow() is None
+
+    breaker.record(trial, True, 0)
+    assert breaker.opened_at is None
+    assert breaker.allow() is not None
+
+
+def test_stale_failure_does_not_restart_cooldown(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(llm.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(window=10, min_calls=2, error_rate=0.5, latency_threshold=60, cooldown=60)
+
+    stale = breaker.allow()
+    open_breaker(breaker)
+    now[0] = 61
+    breaker.record(stale, False, 0)
+    assert breaker.opened_at == 0
+    assert breaker.allow() is not None
+
+
+def test_call_from_previous_closed_period_is_ignored(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(llm.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(window=10, min_calls=2, error_rate=0.5, latency_threshold=60, cooldown=60)
+
+    stale = breaker.allow()
+    open_breaker(breaker)
+    now[0] = 61
+    breaker.record(breaker.allow(), True, 0)
+    assert breaker.opened_at is None
+
+    breaker.record(stale, False, 0)
+    assert list(breaker.results) == []
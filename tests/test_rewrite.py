@@ -0,0 +1,55 @@
+import pytest
+
+import main
+
+PROFILE = main.demographic_profiles["elderly"]
+
+
+def test_parse_plain_json():
+    text = '{"personalized": "Врач молодец, всё объяснил.", "final": "Врач молодец."}'
+    assert main.parse_rewrite_result(text) == ("Врач молодец.", "Врач молодец, всё объяснил.")
+
+
+def test_parse_fenced_json():
+    text = '```json\n{"personalized": "Всё супер, врач молодец.", "final": "Всё супер!"}\n```'
+    assert main.parse_rewrite_result(text) == ("Всё супер!", "Всё супер, врач молодец.")
+
+
+def test_parse_without_personalized_version():
+    assert main.parse_rewrite_result('{"final": "Всё супер!"}') == ("Всё супер!", None)
+
+
+@pytest.mark.parametrize("text", [
+    # Ответ обрезан по max_tokens
+    '{"personalized": "Всё супер, врач молодец.", "final": "Всё супер',
+    '{"personalized": "Всё супер, врач молодец.", "final": "  "}',
+    '{"personalized": "Всё супер, врач молодец."}',
+    '{"personalized": "Всё супер", "final": null}',
+    "Всё супер, врач молодец.",
+])
+def test_parse_rejects_broken_reply(text):
+    with pytest.raises(ValueError):
+        main.parse_rewrite_result(text)
+
+
+def test_prompt_combined_mode_asks_for_json():
+    prompt = main.build_rewrite_prompt("Отличная клиника.", PROFILE, humanize=True, max_sentences=3)
+    assert PROFILE["name"] in prompt
+    assert "не более 3 предложений" in prompt
+    assert '"personalized"' in prompt and '"final"' in prompt
+    # Правила очеловечивания относятся ко второму шагу, а не к персонализации
+    assert prompt.index(main.HUMANIZE_RULES[0]) > prompt.index("Затем")
+
+
+@pytest.mark.parametrize("profile, humanize", [(PROFILE, False), (None, True)])
+def test_prompt_single_mode_returns_plain_text(profile, humanize):
+    prompt = main.build_rewrite_prompt("Отличная клиника.", profile, humanize=humanize, max_sentences=4)
+    assert "JSON" not in prompt
+    assert prompt.endswith("Верни только новую версию отзыва.")
+    assert "\"Отличная клиника.\"" in prompt
+    assert (main.HUMANIZE_RULES[0] in prompt) == (profile is None)
+
+
+def test_prompt_without_length_limit():
+    prompt = main.build_rewrite_prompt("Отличная клиника.", humanize=True, max_sentences=0)
+    assert "предложений" not in prompt
@@ -0,0 +1,70 @@
+import urllib.parse
+from unittest import mock
+
+import pytest
+
+import main
+
+
+def make_context(review):
+    context = mock.Mock()
+    context.user_data = {}
+    main.set_generated_review(context, review)
+    return context
+
+
+def test_payload_encodes_review():
+    review = "Всё отлично & спасибо! #1"
+    payload = main.build_share_payload(review)
+    encoded = urllib.parse.quote(review)
+    assert payload == {
+        "whatsapp_url": f"https://api.whatsapp.com/send?text={encoded}",
+        "telegram_url": f"https://t.me/share/url?url={encoded}",
+    }
+    assert "&" not in encoded and "#" not in encoded and " " not in encoded
+
+
+def test_payload_length_cutoff(monkeypatch):
+    review = "Отзыв"
+    whatsapp_length = len(main.build_share_payload(review)["whatsapp_url"])
+    telegram_length = len(main.build_share_payload(review)["telegram_url"])
+    assert telegram_length < whatsapp_length
+
+    monkeypatch.setattr(main, "MAX_SHARE_URL_LENGTH", whatsapp_length)
+    payload = main.build_share_payload(review)
+    assert payload["whatsapp_url"] and payload["telegram_url"]
+
+    monkeypatch.setattr(main, "MAX_SHARE_URL_LENGTH", whatsapp_length - 1)
+    payload = main.build_share_payload(review)
+    assert payload["whatsapp_url"] is None
+    assert payload["telegram_url"]
+
+    monkeypatch.setattr(main, "MAX_SHARE_URL_LENGTH", telegram_length - 1)
+    assert main.build_share_payload(review) == {"whatsapp_url": None, "telegram_url": None}
+
+
+def test_buttons_use_links_when_they_fit():
+    context = make_context("Короткий отзыв")
+    whatsapp, telegram = main.share_buttons(context)
+    assert whatsapp.url == context.user_data["share_payload"]["whatsapp_url"]
+    assert whatsapp.callback_data is None
+    assert telegram.url == context.user_data["share_payload"]["telegram_url"]
+
+
+@pytest.mark.parametrize("length", [10, 4096])
+def test_buttons_fall_back_to_callback(monkeypatch, length):
+    monkeypatch.setattr(main, "MAX_SHARE_URL_LENGTH", length)
+    # Кириллица при кодировании занимает 6 символов на букву
+    context = make_context("Очень длинный отзыв " * 50)
+    buttons = main.share_buttons(context)
+    assert len(buttons) == 1
+    assert buttons[0].url is None
+    assert buttons[0].callback_data == "send_whatsapp"
+
+
+def test_buttons_follow_review_changes():
+    context = make_context("Первый")
+    first = main.share_buttons(context)[0].url
+    main.set_generated_review(context, "Второй")
+    assert main.share_buttons(context)[0].url != first
+    assert urllib.parse.quote("Второй") in main.share_buttons(context)[0].url
@@ -0,0 +1,142 @@
+from datetime import date
+from unittest import mock
+
+import pytest
+
+import usage
+from usage import UsageTracker, QuotaExceededError
+
+
+class FakeDate(date):
+    current = date(2026, 10, 18)
+
+    @classmethod
+    def today(cls):
+        return cls.current
+
+
+@pytest.fixture
+def fake_date(monkeypatch):
+    FakeDate.current = date(2026, 10, 18)
+    monkeypatch.setattr(usage, "date", FakeDate)
+    return FakeDate
+
+
+def test_minute_quota():
+    tracker = UsageTracker(user_per_minute=2, user_per_day=0, business_tokens_per_day=0)
+    tracker.check_quota(1, "clinic")
+    tracker.check_quota(1, "clinic")
+    with pytest.raises(QuotaExceededError):
+        tracker.check_quota(1, "clinic")
+    # Квота считается отдельно для каждого пользователя
+    tracker.check_quota(2, "clinic")
+
+
+def test_daily_user_and_business_quotas():
+    tracker = UsageTracker(user_per_minute=0, user_per_day=2, business_tokens_per_day=100)
+    tracker.record(1, "clinic", tokens=10)
+    tracker.record(1, "clinic", tokens=10)
+    with pytest.raises(QuotaExceededError):
+        tracker.check_quota(1, "clinic")
+
+    tracker.record(2, "clinic", tokens=80)
+    with pytest.raises(QuotaExceededError):
+        tracker.check_quota(3, "clinic")
+    tracker.check_quota(3, "salon")
+
+
+def test_daily_counters_reset_at_midnight(fake_date):
+    tracker = UsageTracker(user_per_minute=0, user_per_day=1, business_tokens_per_day=0)
+    tracker.record(1, "clinic", tokens=10)
+    with pytest.raises(QuotaExceededError):
+        tracker.check_quota(1, "clinic")
+
+    fake_date.current = date(2026, 10, 19)
+    tracker.check_quota(1, "clinic")
+
+
+def test_failed_midnight_flush_keeps_original_day(fake_date):
+    tracker = UsageTracker(user_per_minute=0, user_per_day=0, business_tokens_per_day=0)
+    tracker.record(1, "clinic", tokens=10)
+
+    fake_date.current = date(2026, 10, 19)
+    with mock.patch.object(usage, "save_usage", side_effect=RuntimeError("db down")):
+        tracker.flush()
+    tracker.record(1, "clinic", tokens=5)
+
+    with mock.patch.object(usage, "save_usage") as save_usage:
+        tracker.flush()
+    save_usage.assert_has_calls([
+        mock.call(date(2026, 10, 18), [(1, "clinic", 1, 10)]),
+        mock.call(date(2026, 10, 19), [(1, "clinic", 1, 5)]),
+    ])
+    assert not tracker.pending
+
+
+def test_flush_does_not_hold_lock():
+    tracker = UsageTracker()
+    tracker.record(1, "clinic", tokens=10)
+
+    def save_usage(day, rows):
+        assert not tracker.lock.locked()
+
+    with mock.patch.object(usage, "save_usage", side_effect=save_usage) as patched:
+        tracker.flush()
+    assert patched.called
+
+
+def test_report():
+    tracker = UsageTracker()
+    tracker.record(1, "clinic", tokens=10)
+    tracker.record(2, "clinic", tokens=30)
+    tracker.record(3, "salon", tokens=5)
+    by_business, by_user = tracker.report()
+    assert by_business == {"clinic": [2, 40], "salon": [1, 5]}
+    assert by_user[0] == (2, "clinic", 1, 30)
+
+
+def test_release_returns_minute_slot():
+    tracker = UsageTracker(user_per_minute=1, user_per_day=0, business_tokens_per_day=0)
+    reserved_at = tracker.check_quota(1, "clinic")
+    tracker.release(1, reserved_at)
+    tracker.check_quota(1, "clinic")
+    with pytest.raises(QuotaExceededError):
+        tracker.check_quota(1, "clinic")
+
+
+def test_failed_call_does_not_use_minute_quota(monkeypatch):
+    import main
+
+    tracker = UsageTracker(user_per_minute=1, user_per_day=0, business_tokens_per_day=0)
+    backend = mock.Mock()
+    backend.complete.side_effect = TimeoutError("timeout")
+    monkeypatch.setattr(main, "usage_tracker", tracker)
+    monkeypatch.setattr(main, "llm_backend", backend)
+
+    for _ in range(3):
+        with pytest.raises(TimeoutError):
+            main.chat_completion(1, "clinic", "gpt-4o", [], 0.7, 200)
+    assert not tracker.recent_calls[1]
+    assert not tracker.daily
+
+
+def test_running_totals_follow_records_load_and_rollover(fake_date):
+    tracker = UsageTracker(user_per_minute=0, user_per_day=3, business_tokens_per_day=100)
+    with mock.patch.object(usage, "get_usage", return_value=[(1, "clinic", 2, 40), (2, "clinic", 1, 50)]):
+        tracker.load()
+    assert tracker.user_calls == {1: 2, 2: 1}
+    assert tracker.business_tokens == {"clinic": 90}
+
+    tracker.record(1, "salon", tokens=10)
+    assert tracker.user_calls[1] == 3
+    assert tracker.business_tokens == {"clinic": 90, "salon": 10}
+    with pytest.raises(QuotaExceededError):
+        tracker.check_quota(1, "salon")
+
+    tracker.record(2, "clinic", tokens=10)
+    with pytest.raises(QuotaExceededError):
+        tracker.check_quota(3, "clinic")
+
+    fake_date.current = date(2026, 10, 19)
+    tracker.check_quota(1, "clinic")
+    assert not tracker.user_calls and not tracker.business_tokens
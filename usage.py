@@ -0,0 +1,180 @@
+# список импортов
+import os
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from datetime import date
+from dotenv import load_dotenv
+from db import save_usage, get_usage
+
+logger = logging.getLogger(__name__)
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+# Квоты на генерации (0 — без ограничения)
+QUOTA_USER_PER_MINUTE = int(os.getenv("QUOTA_USER_PER_MINUTE", "5"))
+QUOTA_USER_PER_DAY = int(os.getenv("QUOTA_USER_PER_DAY", "100"))
+QUOTA_BUSINESS_TOKENS_PER_DAY = int(os.getenv("QUOTA_BUSINESS_TOKENS_PER_DAY", "200000"))
+
+# Как часто сбрасывать накопленные счетчики в базу (секунды)
+USAGE_FLUSH_INTERVAL = int(os.getenv("USAGE_FLUSH_INTERVAL", "60"))
+
+
+class QuotaExceededError(Exception):
+    """Пользователь или тип бизнеса исчерпал квоту на обращения к модели."""
+
+
+class UsageTracker:
+    """
+    Учитывает обращения к модели и израсходованные токены по telegram_id и business_type.
+    Счетчики хранятся в памяти и периодически сбрасываются в таблицу usage_stats.
+    """
+
+    def __init__(
+        self,
+        user_per_minute=QUOTA_USER_PER_MINUTE,
+        user_per_day=QUOTA_USER_PER_DAY,
+        business_tokens_per_day=QUOTA_BUSINESS_TOKENS_PER_DAY,
+    ):
+        self.user_per_minute = user_per_minute
+        self.user_per_day = user_per_day
+        self.business_tokens_per_day = business_tokens_per_day
+        self.lock = threading.Lock()
+        self.day = date.today()
+        # Итоги за текущий день: {(telegram_id, business_type): [calls, tokens]}
+        self.daily = defaultdict(lambda: [0, 0])
+        # Те же итоги, свернутые для проверки квот без перебора daily:
+        # {telegram_id: calls} и {business_type: tokens}
+        self.user_calls = defaultdict(int)
+        self.business_tokens = defaultdict(int)
+        # Еще не сохраненные в базу приращения: {(day, telegram_id, business_type): [calls, tokens]}
+        self.pending = defaultdict(lambda: [0, 0])
+        # Время последних обращений пользователя для минутной квоты
+        self.recent_calls = defaultdict(deque)
+
+    def load(self):
+        """Подгружает итоги за сегодня из базы, чтобы перезапуск бота не обнулял квоты."""
+        rows = get_usage(self.day)
+        with self.lock:
+            for telegram_id, business_type, calls, tokens in rows:
+                counters = self.daily[(telegram_id, business_type)]
+                self.user_calls[telegram_id] += calls - counters[0]
+                self.business_tokens[business_type] += tokens - counters[1]
+                counters[0], counters[1] = calls, tokens
+        logger.info(f"Загружена статистика использования: {len(rows)} записей")
+
+    def _rollover(self):
+        # Несохраненные приращения хранят свой день, поэтому при смене дня
+        # достаточно обнулить дневные итоги; в базу они попадут при следующем сбросе
+        today = date.today()
+        if today != self.day:
+            self.day = today
+            self.daily.clear()
+            self.user_calls.clear()
+            self.business_tokens.clear()
+
+    def check_quota(self, telegram_id, business_type):
+        """
+        Проверяет квоты перед обращением к модели и резервирует место в минутном окне.
+        Возвращает метку резерва для release. Бросает QuotaExceededError, если квота исчерпана.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self._rollover()
+
+            recent = self.recent_calls[telegram_id]
+            while recent and now - recent[0] > 60:
+                recent.popleft()
+            if self.user_per_minute and len(recent) >= self.user_per_minute:
+                raise QuotaExceededError("Слишком много запросов за минуту. Попробуйте чуть позже.")
+
+            if self.user_per_day and self.user_calls.get(telegram_id, 0) >= self.user_per_day:
+                raise QuotaExceededError("Дневной лимит генераций исчерпан. Попробуйте завтра.")
+
+            if self.business_tokens_per_day and self.business_tokens.get(business_type, 0) >= self.business_tokens_per_day:
+                logger.warning(f"Тип бизнеса {business_type} исчерпал дневной лимит токенов")
+                raise QuotaExceededError("Дневной лимит для вашей организации исчерпан. Попробуйте завтра.")
+
+            recent.append(now)
+        return now
+
+    def release(self, telegram_id, reserved_at):
+        """Возвращает место в минутном окне, если обращение к модели не состоялось."""
+        with self.lock:
+            try:
+                self.recent_calls[telegram_id].remove(reserved_at)
+            except ValueError:
+                # Резерв уже вытеснен из окна
+                pass
+
+    def record(self, telegram_id, business_type, tokens, calls=1):
+        """Учитывает выполненное обращение к модели."""
+        with self.lock:
+            self._rollover()
+            for counters in (self.daily[(telegram_id, business_type)], self.pending[(self.day, telegram_id, business_type)]):
+                counters[0] += calls
+                counters[1] += tokens
+            self.user_calls[telegram_id] += calls
+            self.business_tokens[business_type] += tokens
+
+    def flush(self):
+        """
+        Сохраняет накопленные приращения в базу, каждое под своим днем.
+        Запись идет без блокировки, чтобы не задерживать проверку квот.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(lambda: [0, 0])
+        if not pending:
+            return
+
+        by_day = defaultdict(list)
+        for (day, user, business), (calls, tokens) in pending.items():
+            by_day[day].append((user, business, calls, tokens))
+
+        for day, rows in sorted(by_day.items()):
+            try:
+                save_usage(day, rows)
+            except Exception as e:
+                # Возвращаем несохраненные данные до следующей попытки
+                logger.error(f"Не удалось сохранить статистику использования за {day}: {e}")
+                with self.lock:
+                    for user, business, calls, tokens in rows:
+                        counters = self.pending[(day, user, business)]
+                        counters[0] += calls
+                        counters[1] += tokens
+
+    def report(self):
+        """
+        Возвращает итоги за текущий день:
+        ({business_type: [calls, tokens]}, [(telegram_id, business_type, calls, tokens), ...]).
+        """
+        with self.lock:
+            self._rollover()
+            by_business = defaultdict(lambda: [0, 0])
+            by_user = []
+            for (user, business), (calls, tokens) in self.daily.items():
+                by_business[business][0] += calls
+                by_business[business][1] += tokens
+                by_user.append((user, business, calls, tokens))
+        by_user.sort(key=lambda row: row[3], reverse=True)
+        return dict(by_business), by_user
+
+
+def format_report(tracker, top=10):
+    """Текстовый отчет об использовании для администраторов."""
+    by_business, by_user = tracker.report()
+    lines = [f"📊 Использование за {tracker.day.isoformat()}"]
+    if not by_user:
+        lines.append("Обращений к модели пока не было.")
+        return "\n".join(lines)
+
+    lines.append("\nПо типам бизнеса:")
+    for business, (calls, tokens) in sorted(by_business.items(), key=lambda item: item[1][1], reverse=True):
+        lines.append(f"• {business}: {calls} запросов, {tokens} токенов")
+
+    lines.append(f"\nТоп-{top} пользователей:")
+    for user, business, calls, tokens in by_user[:top]:
+        lines.append(f"• {user} ({business}): {calls} запросов, {tokens} токенов")
+    return "\n".join(lines)